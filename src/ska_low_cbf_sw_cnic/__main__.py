@@ -15,8 +15,20 @@ import textwrap
 
 from ska_low_cbf_fpga.fpga_cmdline import FpgaCmdline
 
-import ska_low_cbf_sw_cnic.monitor as monitor
-from ska_low_cbf_sw_cnic.cnic_fpga import CnicFpga
+_display_log_handler = logging.StreamHandler()
+_display_log_handler.setLevel(logging.DEBUG)
+_display_log_handler.setFormatter(
+    logging.Formatter("%(levelname)s: %(message)s")
+)
+
+
+def _display_status_forever(fpga) -> None:
+    """Run the monitoring display, see monitor.display_status_forever"""
+    # deferred import, the display code is only needed here
+    # pylint: disable=import-outside-toplevel
+    from ska_low_cbf_sw_cnic.monitor import display_status_forever
+
+    display_status_forever(fpga)
 
 
 class CnicCmdline(FpgaCmdline):
@@ -79,20 +91,27 @@ class CnicCmdline(FpgaCmdline):
     def run(self):
         """Overload run to add extra sub-commands"""
         super().run()
-        command = self.args.command
         fpga = self.fpgas[self.args.cards[0]]
         # TODO move logger config to ska-low-cbf-fpga
-        display_log_handler = logging.StreamHandler()
-        display_log_handler.setLevel(logging.DEBUG)
-        display_log_handler.setFormatter(
-            logging.Formatter("%(levelname)s: %(message)s")
-        )
-        self.logger.addHandler(display_log_handler)
-
+        # (only add our handler once, even if run more than once)
+        if _display_log_handler not in self.logger.handlers:
+            self.logger.addHandler(_display_log_handler)
+
+        try:
+            self._run_command(fpga)
+            # let any capture finish being written before we exit
+            fpga.wait_receive()
+        finally:
+            # cancels any Rx wait still pending (e.g. on Ctrl-C)
+            fpga.close()
+
+    def _run_command(self, fpga):
+        """Execute the sub-command given on the command line"""
+        command = self.args.command
         if command:
             base_cmd = str.lower(command[0])
             if base_cmd == "monitor":
-                monitor.display_status_forever(fpga)
+                _display_status_forever(fpga)
             elif base_cmd == "tx":
                 assert (
                     2 <= len(command) <= 5
@@ -129,11 +148,15 @@ class CnicCmdline(FpgaCmdline):
                 raise NotImplementedError(f"No such command {command[0]}")
 
             if self.args.monitor:
-                monitor.display_status_forever(fpga)
+                _display_status_forever(fpga)
 
 
 def main():
     """CNIC CLI main function"""
+    # deferred import, importing this module alone needn't load the ICL
+    # pylint: disable=import-outside-toplevel
+    from ska_low_cbf_sw_cnic.cnic_fpga import CnicFpga
+
     CnicCmdline(personality=CnicFpga)
 
 
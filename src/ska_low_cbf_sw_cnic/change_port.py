@@ -3,21 +3,161 @@
 """Change the port in a pcap file"""
 
 import argparse
+import mmap
+import struct
+import typing
 
-from scapy.all import UDP, rdpcap, wrpcap
+import numpy as np
 
+from ska_low_cbf_sw_cnic.pcap import (
+    PCAP_RECORD_HEADER_SIZE,
+    frame_spans,
+    preallocate,
+    uniform_pcap_records,
+)
 
-def change_port(packets, port, output_file):
-    for packet in packets:
-        if packet.haslayer(UDP):
-            packet[UDP].dport = port
-            wrpcap(output_file, packet, append=True)
+ETH_HEADER_SIZE = 14
+ETH_TYPE_IPV4 = b"\x08\x00"
+ETH_TYPE_VLAN = (b"\x81\x00", b"\x88\xa8", b"\x91\x00")
+"""802.1Q / 802.1ad (QinQ) tag protocol identifiers"""
+VLAN_TAG_SIZE = 4
+IP_PROTO_UDP = 17
+UDP_HEADER_SIZE = 8
+
+
+def _checksum_update(checksum: int, old: int, new: int) -> int:
+    """
+    Incrementally update a 16-bit ones' complement checksum (RFC 1624)
+    :param checksum: existing checksum
+    :param old: old value of the 16-bit field that changed
+    :param new: new value of the field
+    :return: updated checksum
+    """
+    # HC' = ~(~HC + ~m + m')
+    total = (~checksum & 0xFFFF) + (~old & 0xFFFF) + new
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _set_udp_dport(buf, offset: int, length: int, port: int) -> bool:
+    """
+    Set the UDP destination port of one Ethernet/IPv4/UDP frame, in place
+    :param buf: writable buffer containing the frame
+    :param offset: offset of the frame within buf
+    :param length: frame length (Bytes)
+    :param port: new UDP destination port
+    :return: True if the frame was modified (i.e. it was UDP)
+    """
+    # skip over any VLAN tags to find the real EtherType
+    eth_type = offset + 12
+    while (
+        buf[eth_type : eth_type + 2] in ETH_TYPE_VLAN
+        and eth_type + VLAN_TAG_SIZE + 2 <= offset + length
+    ):
+        eth_type += VLAN_TAG_SIZE
+    ip = eth_type + 2
+    if (
+        ip + 20 + UDP_HEADER_SIZE > offset + length
+        or buf[eth_type : eth_type + 2] != ETH_TYPE_IPV4
+        or buf[ip + 9] != IP_PROTO_UDP
+        # only the first fragment of a datagram carries the UDP header
+        or struct.unpack_from(">H", buf, ip + 6)[0] & 0x1FFF
+    ):
+        return False
+    udp = ip + (buf[ip] & 0x0F) * 4
+    if udp + UDP_HEADER_SIZE > offset + length:
+        return False
+
+    old_port, checksum = struct.unpack_from(">H2xH", buf, udp + 2)
+    struct.pack_into(">H", buf, udp + 2, port)
+    if checksum:  # zero means "no checksum" for UDP over IPv4
+        # a computed zero is transmitted as all ones
+        checksum = _checksum_update(checksum, old_port, port) or 0xFFFF
+        struct.pack_into(">H", buf, udp + 6, checksum)
+    return True
+
+
+def _set_udp_dports_uniform(buf, port: int) -> typing.Union[int, None]:
+    """
+    Set the UDP destination port of all packets in a PCAP file, in place,
+    using vectorised operations. Only works when all packets are the same
+    size with the same IP header length and no VLAN tags (as in CNIC
+    captures).
+    :param buf: writable buffer containing the whole file
+    :param port: new UDP destination port
+    :return: number of packets modified,
+    or None if the file is not suitable for this method
+    """
+    records = uniform_pcap_records(buf)
+    if records is None:
+        return None
+    packet_size = records.shape[1] - PCAP_RECORD_HEADER_SIZE
+    if packet_size < ETH_HEADER_SIZE + 20 + UDP_HEADER_SIZE:
+        return None
+
+    frames = records[:, PCAP_RECORD_HEADER_SIZE:]
+    eth_types = frames[:, 12:14].view(">u2")[:, 0]
+    ip_header_lengths = (frames[:, ETH_HEADER_SIZE] & 0x0F) * 4
+    if np.any(ip_header_lengths != ip_header_lengths[0]) or np.any(
+        np.isin(eth_types, [int.from_bytes(t, "big") for t in ETH_TYPE_VLAN])
+    ):
+        return None
+
+    ip = ETH_HEADER_SIZE
+    udp = ip + int(ip_header_lengths[0])
+    if udp + UDP_HEADER_SIZE > packet_size:
+        return None
+    is_udp = (
+        (eth_types == 0x0800)
+        & (frames[:, ip + 9] == IP_PROTO_UDP)
+        & (frames[:, ip + 6 : ip + 8].view(">u2")[:, 0] & 0x1FFF == 0)
+    )
+    dports = frames[:, udp + 2 : udp + 4].view(">u2")[:, 0]
+    checksums = frames[:, udp + 6 : udp + 8].view(">u2")[:, 0]
+
+    # RFC 1624 incremental checksum update, for packets that have one
+    update = is_udp & (checksums != 0)
+    total = (
+        (~checksums[update] & 0xFFFF).astype(np.uint32)
+        + (~dports[update] & 0xFFFF)
+        + port
+    )
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    new_checksums = ~total & 0xFFFF
+    new_checksums[new_checksums == 0] = 0xFFFF
+    checksums[update] = new_checksums
+    dports[is_udp] = port
+    return int(np.count_nonzero(is_udp))
+
+
+def change_port(
+    in_file: typing.BinaryIO, port: int, out_file: typing.BinaryIO
+) -> int:
+    """
+    Copy a PCAP(NG) file, changing the UDP destination port of all packets
+    :param in_file: input PCAP(NG) file
+    :param port: new UDP destination port
+    :param out_file: file to write to
+    :return: number of UDP packets modified
+    """
+    # private copy-on-write mapping, the input file itself is not modified
+    with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_COPY) as buf:
+        n_changed = _set_udp_dports_uniform(buf, port)
+        if n_changed is None:
+            n_changed = 0
+            for offset, length in frame_spans(buf):
+                n_changed += _set_udp_dport(buf, offset, length, port)
+        preallocate(out_file, len(buf))
+        out_file.write(buf)
+    return n_changed
 
 
 def main():
     argparser = argparse.ArgumentParser(description="pcap Port Change")
     argparser.add_argument(
-        "input", type=argparse.FileType("r"), help="Input pcap trace file"
+        "input", type=argparse.FileType("rb"), help="Input pcap trace file"
     )
     argparser.add_argument(
         "--port",
@@ -29,12 +169,13 @@ def main():
     argparser.add_argument(
         "--output",
         "-o",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb"),
         help="Output pcap file name. Default: new_port.pcap",
         default="new_port.pcap",
     )
     args = argparser.parse_args()
-    change_port(rdpcap(args.input.name), args.port, args.output.name)
+    n_changed = change_port(args.input, args.port, args.output)
+    print(f"Changed {n_changed} packets, written to {args.output.name}")
 
 
 if __name__ == "__main__":
@@ -8,10 +8,11 @@
 """
 CNIC FPGA Firmware ICL (Instrument Control Layer)
 """
+import functools
 import logging
 import threading
-import time
 import typing
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from packaging import version
 from packaging.specifiers import SpecifierSet
@@ -24,17 +25,24 @@ from ska_low_cbf_fpga import (
 from ska_low_cbf_fpga.args_fpga import WORD_SIZE
 
 from ska_low_cbf_sw_cnic.hbm_packet_controller import HbmPacketController
-from ska_low_cbf_sw_cnic.pcap import (
-    count_packets_in_pcap,
-    packet_size_from_pcap,
-)
+from ska_low_cbf_sw_cnic.pcap import scan_pcap
 from ska_low_cbf_sw_cnic.ptp import Ptp
 from ska_low_cbf_sw_cnic.ptp_scheduler import PtpScheduler
 
-RX_SLEEP_TIME = 5
-"""wait this many seconds between checking if Rx is finished"""
-LOAD_SLEEP_TIME = 5
-"""wait this many seconds between checking if Load is finished"""
+_CNIC_PERSONALITY = "CNIC"
+"""Firmware personality code we require"""
+_CNIC_FW_SPEC = SpecifierSet("~=0.1.2")
+"""Firmware versions we support
+(earlier versions lack some registers we use)"""
+
+
+@functools.lru_cache(maxsize=None)
+def _mac_low_bytes(mac: str) -> int:
+    """
+    Get the low 3 bytes of a MAC address
+    :param mac: colon-separated hex bytes "01:02:03:04:05:06"
+    """
+    return int.from_bytes(bytes.fromhex(mac.replace(":", ""))[-3:], "big")
 
 
 class CnicFpga(FpgaPersonality):
@@ -68,8 +76,11 @@ class CnicFpga(FpgaPersonality):
         (Note: only present for some firmware versions / FPGA cards)
         """
         super().__init__(interfaces, map_, logger)
-        # check FW version (earlier versions lack some registers we use)
-        self._check_fw("CNIC", "~=0.1.2")
+        # firmware can't change without creating a new object,
+        # so these are only read once (see fw_version, fw_personality)
+        self._fw_version = None
+        self._fw_personality = None
+        self._check_fw()
 
         self._configure_ptp(self["timeslave"], ptp_domain, 0)
         # We don't always have 2x PTP cores
@@ -84,15 +95,27 @@ class CnicFpga(FpgaPersonality):
                 self._logger.warning("No PTP source B available")
 
         self._rx_cancel = threading.Event()
-        self._rx_thread = None
-        self._load_thread = None
+        # persistent worker threads for PCAP loading & Rx completion,
+        # a single worker each so only one of each task runs at a time
+        self._load_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cnic_load"
+        )
+        self._rx_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cnic_rx"
+        )
+        self._rx_future = None
+        self._load_future = None
         self._requested_pcap = None
 
-    def _check_fw(self, personality: str, version_spec: str) -> None:
+    def _check_fw(
+        self,
+        personality: str = _CNIC_PERSONALITY,
+        version_spec: typing.Union[SpecifierSet, str] = _CNIC_FW_SPEC,
+    ) -> None:
         """
         Check the FPGA firmware is the right personality & version.
         :param personality: 4-character personality code
-        :param version_spec: version specification string (e.g. "~=1.2.3")
+        :param version_spec: version specification (e.g. "~=1.2.3")
         See PEP 440 for details.
         (~= means major must match, minor/patch must be >= specified)
         :raises: RuntimeError if requirements not met
@@ -109,8 +132,9 @@ class CnicFpga(FpgaPersonality):
                 f". Expected: {personality} (0x{int_required:x})."
             )
 
-        spec = SpecifierSet(version_spec)
-        if not spec.contains(version.parse(self.fw_version.value)):
+        if isinstance(version_spec, str):
+            version_spec = SpecifierSet(version_spec)
+        if not version_spec.contains(version.parse(self.fw_version.value)):
             raise RuntimeError(
                 f"Wrong firmware version: {self.fw_version.value}."
                 f" Expected: {version_spec}"
@@ -123,19 +147,21 @@ class CnicFpga(FpgaPersonality):
         major.minor.patch
         """
         # TODO move to ska-low-cbf-fpga !
-        fw_ver = (
-            f"{self.system.firmware_major_version.value}."
-            f"{self.system.firmware_minor_version.value}."
-            f"{self.system.firmware_patch_version.value}"
-        )
-        return IclField(
-            description="Firmware Version",
-            format="%s",
-            type_=str,
-            value=fw_ver,
-            user_error=False,
-            user_write=False,
-        )
+        if self._fw_version is None:
+            fw_ver = (
+                f"{self.system.firmware_major_version.value}."
+                f"{self.system.firmware_minor_version.value}."
+                f"{self.system.firmware_patch_version.value}"
+            )
+            self._fw_version = IclField(
+                description="Firmware Version",
+                format="%s",
+                type_=str,
+                value=fw_ver,
+                user_error=False,
+                user_write=False,
+            )
+        return self._fw_version
 
     @property
     def fw_personality(self) -> IclField[str]:
@@ -143,17 +169,19 @@ class CnicFpga(FpgaPersonality):
         Get the FPGA Firmware personality, decoded to a string
         """
         # TODO move to ska-low-cbf-fpga !
-        personality = int.to_bytes(
-            self.system.firmware_personality.value, WORD_SIZE, "big"
-        ).decode(encoding="ascii")
-        return IclField(
-            description="Firmware Personality",
-            format="%s",
-            type_=str,
-            value=personality,
-            user_error=False,
-            user_write=False,
-        )
+        if self._fw_personality is None:
+            personality = int.to_bytes(
+                self.system.firmware_personality.value, WORD_SIZE, "big"
+            ).decode(encoding="ascii")
+            self._fw_personality = IclField(
+                description="Firmware Personality",
+                format="%s",
+                type_=str,
+                value=personality,
+                user_error=False,
+                user_write=False,
+            )
+        return self._fw_personality
 
     def _configure_ptp(
         self, ptp: Ptp, ptp_domain: int, alveo_mac_index: int = 0
@@ -165,16 +193,14 @@ class CnicFpga(FpgaPersonality):
         MAC address
         :param ptp_domain: PTP domain number
         """
-        alveo_macs = [_["address"] for _ in self.info["platform"]["macs"]]
-        alveo_mac = alveo_macs[alveo_mac_index]
-        # MAC is str, colon-separated hex bytes "01:02:03:04:05:06"
+        alveo_mac = self.info["platform"]["macs"][alveo_mac_index]["address"]
         self._logger.info(f"Alveo MAC address: {alveo_mac}")
-        # take low 3 bytes of mac, convert to int
-        alveo_mac_low = int("".join(alveo_mac.split(":")[-3:]), 16)
         # configure the PTP core to use the same low 3 MAC bytes
         # (high bytes are set by the PTP core)
-        ptp.startup(alveo_mac_low, ptp_domain)
-        self._logger.info(f"  PTP MAC address: {ptp.mac_address.value}")
+        ptp.startup(_mac_low_bytes(alveo_mac), ptp_domain)
+        # (reading the PTP MAC address costs several register reads)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"  PTP MAC address: {ptp.mac_address.value}")
 
     def prepare_transmit(
         self,
@@ -198,14 +224,15 @@ class CnicFpga(FpgaPersonality):
                 f"Loading {self._requested_pcap} still in progress!"
             )
         self._requested_pcap = in_filename
-        packet_size = packet_size_from_pcap(in_filename)
-        if self.hbm_pktcontroller.loaded_pcap.value == self._requested_pcap:
+        self._logger.info("Scanning packets in file")
+        packet_size, n_packets = scan_pcap(in_filename)
+        already_loaded = (
+            self.hbm_pktcontroller.loaded_pcap.value == self._requested_pcap
+        )
+        if already_loaded:
             # if we've already loaded the pacp, use the old count
             # (it may be less than the number of packets in the file!)
             n_packets = self.hbm_pktcontroller.tx_packet_to_send.value
-        else:
-            self._logger.info("Counting packets in file")
-            n_packets = count_packets_in_pcap(in_filename)
 
         self.hbm_pktcontroller.tx_enable = False
         self.hbm_pktcontroller.tx_reset = True
@@ -214,22 +241,23 @@ class CnicFpga(FpgaPersonality):
             packet_size, n_packets, n_loops, burst_size, burst_gap, rate
         )
 
-        if self.hbm_pktcontroller.loaded_pcap.value != self._requested_pcap:
-            self._load_thread = threading.Thread(
-                target=self.hbm_pktcontroller.load_pcap, args=(in_filename,)
+        if not already_loaded:
+            self._load_future = self._load_executor.submit(
+                self.hbm_pktcontroller.load_pcap, in_filename
+            )
+            self._load_future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future: Future) -> None:
+        """Log any exception raised by a background task"""
+        if not future.cancelled() and future.exception():
+            self._logger.error(
+                "Background task failed", exc_info=future.exception()
             )
-            self._load_thread.start()
 
     @property
     def _load_thread_active(self) -> bool:
-        """Is the PCAP load thread active?"""
-        if self._load_thread:
-            if self._load_thread.is_alive():
-                return True
-            else:
-                self._load_thread.join()
-                self._load_thread = None
-        return False
+        """Is a PCAP load in progress?"""
+        return self._load_future is not None and not self._load_future.done()
 
     @property
     def ready_to_transmit(self) -> IclField[bool]:
@@ -291,8 +319,10 @@ class CnicFpga(FpgaPersonality):
         self.prepare_transmit(
             in_filename, n_loops, burst_size, burst_gap, rate
         )
-        while not self.ready_to_transmit:
-            time.sleep(LOAD_SLEEP_TIME)
+        if self._load_future:
+            wait([self._load_future])
+        if not self.ready_to_transmit:
+            raise RuntimeError(f"Failed to load {in_filename}")
         self.begin_transmit(start_time, stop_time)
 
     def receive_pcap(
@@ -327,21 +357,22 @@ class CnicFpga(FpgaPersonality):
         self._begin_rx_thread(out_filename, packet_size)
 
     def _begin_rx_thread(self, out_filename, packet_size):
-        """Start a thread to wait for receive completion"""
+        """Start a background task to wait for receive completion"""
         self._rx_cancel.clear()
-        self._rx_thread = threading.Thread(
-            target=self._dump_pcap_when_complete,
-            args=(out_filename, packet_size),
+        self._rx_future = self._rx_executor.submit(
+            self._dump_pcap_when_complete, out_filename, packet_size
         )
-        self._rx_thread.start()
+        self._rx_future.add_done_callback(self._log_failure)
 
     def _end_rx_thread(self) -> None:
-        """Close down our last Rx thread"""
+        """Close down our last Rx task"""
         self.stop_receive()
-        if self._rx_thread:
-            self._rx_thread.join()
-            if self._rx_thread.is_alive():
-                raise RuntimeError("Previous Rx thread didn't stop")
+        self.wait_receive()
+
+    def wait_receive(self) -> None:
+        """Block until the last 'receive_pcap' has finished writing its file"""
+        if self._rx_future:
+            wait([self._rx_future])
 
     def stop_receive(self) -> None:
         """
@@ -349,9 +380,18 @@ class CnicFpga(FpgaPersonality):
         (e.g. if we set the wrong number of packets to wait for it may never
         finish automatically)
         """
-        if self._rx_thread:
+        if self._rx_future:
             self._rx_cancel.set()
 
+    def close(self) -> None:
+        """
+        Shut down our background worker threads.
+        Abandons any Rx wait, and waits for running tasks to finish.
+        """
+        self.stop_receive()
+        self._load_executor.shutdown()
+        self._rx_executor.shutdown()
+
     def _dump_pcap_when_complete(
         self,
         out_filename: str,
@@ -362,16 +402,5 @@ class CnicFpga(FpgaPersonality):
         :param out_filename: File object to write to
         :param packet_size: Number of Bytes used for each packet
         """
-        while not (
-            self.hbm_pktcontroller.rx_complete.value
-            or (
-                self.hbm_pktcontroller.rx_packet_count
-                >= self.hbm_pktcontroller.rx_packets_to_capture
-            )
-        ):
-            if self._rx_cancel.wait(timeout=RX_SLEEP_TIME):
-                break
-            print(".", end="", flush=True)
-
-        print("")
+        self.hbm_pktcontroller.wait_rx_complete(self._rx_cancel)
         self.hbm_pktcontroller.dump_pcap(out_filename, packet_size)
@@ -8,11 +8,43 @@
 PCAP file comparison tool
 """
 import argparse
+import mmap
+import os
 import sys
+import typing
+from concurrent.futures import ThreadPoolExecutor
 
-import dpkt
+import numpy as np
 
-from ska_low_cbf_sw_cnic.pcap import get_reader
+from ska_low_cbf_sw_cnic.pcap import (
+    PCAP_RECORD_HEADER_SIZE,
+    READ_BUFFER_SIZE,
+    advise_sequential,
+    frame_spans,
+    get_reader,
+    uniform_pcap_records,
+)
+
+COMPARE_BATCH = 4096
+"""Number of packets to compare at once in vectorised comparisons"""
+
+
+def _is_udp_dport(packet: bytes, dport: bytes) -> bool:
+    """
+    Check if an Ethernet frame is an IPv4 UDP packet for a given port,
+    by looking at the raw header bytes (much faster than decoding it)
+    :param packet: Ethernet frame
+    :param dport: destination port of interest, as 2 big-endian bytes
+    """
+    if (
+        packet[12:14] != b"\x08\x00"  # IPv4
+        or packet[23:24] != b"\x11"  # UDP
+        # only the first fragment of a datagram carries the UDP header
+        or (packet[20] & 0x1F or packet[21])
+    ):
+        return False
+    udp = 14 + (packet[14] & 0x0F) * 4
+    return packet[udp + 2 : udp + 4] == dport
 
 
 def compare_n_packets(
@@ -33,16 +65,12 @@ def compare_n_packets(
 
     index = 0
     differences = []
+    dport = dport.to_bytes(2, "big")
     for (src_ts, src_packet) in packets:
         # skip over captured packets with the wrong dport
         while True:
             (cap_ts, cap_packet) = next(packets_capture)
-            eth_cap = dpkt.ethernet.Ethernet(cap_packet)
-            if (
-                eth_cap.type == dpkt.ethernet.ETH_TYPE_IP
-                and eth_cap.data.p == dpkt.ip.IP_PROTO_UDP
-                and eth_cap.data.data.dport == dport
-            ):
+            if _is_udp_dport(cap_packet, dport):
                 break
 
         if cap_packet != src_packet:
@@ -53,6 +81,163 @@ def compare_n_packets(
     return differences, index
 
 
+def _mapped_packets(buf) -> typing.Iterator[typing.Tuple[None, bytes]]:
+    """
+    Iterate over the packets in an in-memory PCAP(NG) file.
+    A lightweight alternative to get_reader, for when we don't need
+    timestamps (None is given in their place).
+    :param buf: buffer holding the whole file (e.g. an mmap)
+    """
+    for offset, length in frame_spans(buf):
+        yield None, buf[offset : offset + length]
+
+
+def _udp_dport_mask(frames: np.ndarray, dport: int) -> np.ndarray:
+    """
+    Vectorised version of _is_udp_dport
+    :param frames: 2D uint8 array, one Ethernet frame per row
+    :param dport: destination port of interest
+    :return: boolean array, True for rows that are UDP packets to dport
+    """
+    n_frames, frame_size = frames.shape
+    if frame_size < 24:
+        return np.zeros(n_frames, dtype=bool)
+    is_udp = (
+        (frames[:, 12] == 0x08)
+        & (frames[:, 13] == 0x00)
+        & (frames[:, 23] == 17)
+        & (frames[:, 20] & 0x1F == 0)
+        & (frames[:, 21] == 0)
+    )
+    udp = 14 + (frames[:, 14] & 0x0F).astype(np.intp) * 4
+    in_frame = udp + 4 <= frame_size
+    udp[~in_frame] = 0
+    rows = np.arange(n_frames)
+    ports = (frames[rows, udp + 2].astype(np.uint16) << 8) | frames[
+        rows, udp + 3
+    ]
+    return is_udp & in_frame & (ports == dport)
+
+
+def _batches_equal(first: np.ndarray, second: np.ndarray) -> bool:
+    """
+    Check if two arrays of the same shape are identical, stopping at the
+    first batch of rows that differs
+    """
+    return all(
+        np.array_equal(
+            first[start : start + COMPARE_BATCH],
+            second[start : start + COMPARE_BATCH],
+        )
+        for start in range(0, len(first), COMPARE_BATCH)
+    )
+
+
+def _compare_mapped(
+    max_packets, source_buf, capture_buf, dport
+) -> typing.Union[typing.Tuple[list, int, bool], None]:
+    """
+    Compare packets from two in-memory classic PCAP files, using
+    vectorised operations. Only works when all packets in each file are
+    the same size (as in CNIC captures).
+    Parameters as per compare_n_packets, but taking the whole file buffers.
+    :return: tuple of: list of differing packet indices, int number of
+    packets compared, bool True if the comparison could be completed;
+    or None if the files are not suitable for this method
+    """
+    source_records = uniform_pcap_records(source_buf)
+    capture_records = uniform_pcap_records(capture_buf)
+    if source_records is None or capture_records is None:
+        return None
+    source = source_records[:, PCAP_RECORD_HEADER_SIZE:]
+    capture = capture_records[:, PCAP_RECORD_HEADER_SIZE:]
+
+    n_packets = len(source)
+    if max_packets:
+        n_packets = min(n_packets, max_packets)
+    matches = np.flatnonzero(_udp_dport_mask(capture, dport))
+    if len(matches) < n_packets:
+        # same outcome as compare_n_packets running out of captured packets
+        return [], len(matches), False
+    if source.shape[1] != capture.shape[1]:
+        return list(range(n_packets)), n_packets, True
+    if (
+        n_packets
+        and matches[n_packets - 1] == n_packets - 1  # i.e. none filtered
+        and _batches_equal(
+            source_records[:n_packets], capture_records[:n_packets]
+        )
+    ):
+        # e.g. file compared with a copy of itself
+        return [], n_packets, True
+
+    def compare_batch(start: int) -> list:
+        end = min(start + COMPARE_BATCH, n_packets)
+        differ = np.any(
+            capture[matches[start:end]] != source[start:end], axis=1
+        )
+        return (np.flatnonzero(differ) + start).tolist()
+
+    # NumPy releases the GIL while comparing, so batches can be compared
+    # in parallel threads (sharing the memory maps)
+    with ThreadPoolExecutor(
+        max_workers=os.cpu_count(), thread_name_prefix="compare"
+    ) as pool:
+        batches = pool.map(compare_batch, range(0, n_packets, COMPARE_BATCH))
+        differences = [index for batch in batches for index in batch]
+    return differences, n_packets, True
+
+
+def compare_files(
+    max_packets,
+    source_file: typing.BinaryIO,
+    capture_file: typing.BinaryIO,
+    dport: int,
+) -> (list, int):
+    """
+    Compare packets from two PCAP(NG) files.
+    Files are memory mapped if possible. Uniformly sized classic PCAP files
+    are compared with vectorised operations, anything else uses
+    compare_n_packets.
+    Parameters & return value as per compare_n_packets, but taking files.
+    :raises StopIteration: if capture_file runs out before source_file
+    """
+    try:
+        with mmap.mmap(
+            source_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as source_buf, mmap.mmap(
+            capture_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as capture_buf:
+            result = _compare_mapped(
+                max_packets, source_buf, capture_buf, dport
+            )
+            if result is None:
+                try:
+                    result = compare_n_packets(
+                        max_packets,
+                        _mapped_packets(source_buf),
+                        _mapped_packets(capture_buf),
+                        dport,
+                    ) + (True,)
+                except StopIteration:
+                    result = [], 0, False
+    except (OSError, ValueError):
+        # e.g. pipes & empty files can't be mapped
+        # (dpkt will give a better error if a file isn't PCAP)
+        result = None
+    if result is None:
+        return compare_n_packets(
+            max_packets,
+            get_reader(source_file),
+            get_reader(capture_file),
+            dport,
+        )
+    differences, n_compared, complete = result
+    if not complete:
+        raise StopIteration
+    return differences, n_compared
+
+
 def main():
     """PCAP comparison utility main function (CLI)"""
     argparser = argparse.ArgumentParser(
@@ -60,7 +245,7 @@ def main():
     )
     argparser.add_argument(
         "input",
-        type=argparse.FileType("rb"),
+        type=argparse.FileType("rb", bufsize=READ_BUFFER_SIZE),
         nargs=2,
         help="Input pcap files. Second file (only) is filtered by dport.",
     )
@@ -83,13 +268,12 @@ def main():
     )
 
     args = argparser.parse_args()
+    for in_file in args.input:
+        advise_sequential(in_file)
 
     try:
-        differences, n_comp = compare_n_packets(
-            args.packets,
-            get_reader(args.input[0]),
-            get_reader(args.input[1]),
-            args.dport,
+        differences, n_comp = compare_files(
+            args.packets, args.input[0], args.input[1], args.dport
         )
     except StopIteration:
         print(
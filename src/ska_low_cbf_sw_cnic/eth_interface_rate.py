@@ -6,16 +6,57 @@
 # Agreement. See LICENSE for more info.
 """Interface Rate Monitor"""
 import argparse
+import contextlib
 import os
+import subprocess
 import time
+import typing
 from datetime import datetime
 
+COUNTERS = ("rx_packets", "rx_bytes", "tx_packets", "tx_bytes")
+"""Interface statistics to monitor"""
+
 
 def screen_clear():
     """Clear the screen"""
     # for mac and linux(here, os.name is 'posix')
     if os.name == "posix":
-        _ = os.system("clear")
+        # ANSI cursor home & erase display, as output by 'clear'
+        print("\x1b[H\x1b[2J", end="", flush=True)
+
+
+def open_counters(
+    interface: str, stack: contextlib.ExitStack
+) -> typing.Dict[str, typing.TextIO]:
+    """
+    Open the kernel's statistics counter files for a network interface
+    :param interface: network interface name
+    :param stack: files are closed when this exits
+    :return: dict of open files, keyed by counter name
+    """
+    return {
+        counter: stack.enter_context(
+            open(
+                f"/sys/class/net/{interface}/statistics/{counter}",
+                "r",
+                encoding="ascii",
+            )
+        )
+        for counter in COUNTERS
+    }
+
+
+def read_counters(counters: typing.Dict[str, typing.TextIO]) -> dict:
+    """
+    Read the current values of open statistics counter files
+    :param counters: open files, as returned by open_counters
+    :return: dict of int counter values, keyed by counter name
+    """
+    values = {}
+    for counter, file in counters.items():
+        file.seek(0)
+        values[counter] = int(file.read())
+    return values
 
 
 def main():
@@ -34,55 +75,48 @@ def main():
     prev_tx_bytes = 0
     newtime = datetime.now()
 
-    ifconfig = os.popen(f"sudo ifconfig {args.interface} promisc")
-    ifconfig.close()
+    subprocess.run(
+        ["sudo", "ifconfig", args.interface, "promisc"], check=False
+    )
 
-    while True:
-        screen_clear()
-        rate = os.popen(
-            f"ethtool -S {args.interface} | grep -E 'rx_packets:|rx_bytes:'"
-        )
-        stream = rate.read()
-        rx_bytes = int(stream.split()[3])
-        rx_packets = int(stream.split()[1])
-        rate.close()
+    with contextlib.ExitStack() as stack:
+        counters = open_counters(args.interface, stack)
+        while True:
+            screen_clear()
+            values = read_counters(counters)
+            rx_bytes = values["rx_bytes"]
+            rx_packets = values["rx_packets"]
+            tx_bytes = values["tx_bytes"]
+            tx_packets = values["tx_packets"]
 
-        rate_tx = os.popen(
-            f"ethtool -S {args.interface} | grep -E 'tx_packets:|tx_bytes:'"
-        )
-        stream_tx = rate_tx.read()
-        tx_bytes = int(stream_tx.split()[3])
-        tx_packets = int(stream_tx.split()[1])
-        rate_tx.close()
-
-        prevtime = newtime
-        newtime = datetime.now()
-        newtime_ts = newtime.timestamp()
-        prevtime_ts = prevtime.timestamp()
-        timediff_ts = newtime_ts - prevtime_ts
-
-        print(f"{newtime}     timediff_ts = {timediff_ts} s")
-
-        rx_rate = (rx_bytes - prev_rx_bytes) * 8 / timediff_ts
-        tx_rate = (tx_bytes - prev_tx_bytes) * 8 / timediff_ts
-
-        print("\n\n")
-        print(f"          Interface {args.interface}")
-        print("|----------------------------------------")
-        print(f"| Total rx_packets : {rx_packets}")
-        print(f"| Total rx_bytes   : {rx_bytes}")
-        print("|----------------------------------------")
-        print(f"| rx_rate          : {rx_rate/1E9:.6} Gbps")
-        print("|----------------------------------------")
-        print(f"| Total tx_packets : {tx_packets}")
-        print(f"| Total tx_bytes   : {tx_bytes}")
-        print("|----------------------------------------")
-        print(f"| tx_rate          : {tx_rate/1E9:.6} Gbps")
-        print("|----------------------------------------")
-
-        time.sleep(1)
-        prev_rx_bytes = rx_bytes
-        prev_tx_bytes = tx_bytes
+            prevtime = newtime
+            newtime = datetime.now()
+            newtime_ts = newtime.timestamp()
+            prevtime_ts = prevtime.timestamp()
+            timediff_ts = newtime_ts - prevtime_ts
+
+            print(f"{newtime}     timediff_ts = {timediff_ts} s")
+
+            rx_rate = (rx_bytes - prev_rx_bytes) * 8 / timediff_ts
+            tx_rate = (tx_bytes - prev_tx_bytes) * 8 / timediff_ts
+
+            print("\n\n")
+            print(f"          Interface {args.interface}")
+            print("|----------------------------------------")
+            print(f"| Total rx_packets : {rx_packets}")
+            print(f"| Total rx_bytes   : {rx_bytes}")
+            print("|----------------------------------------")
+            print(f"| rx_rate          : {rx_rate/1E9:.6} Gbps")
+            print("|----------------------------------------")
+            print(f"| Total tx_packets : {tx_packets}")
+            print(f"| Total tx_bytes   : {tx_bytes}")
+            print("|----------------------------------------")
+            print(f"| tx_rate          : {tx_rate/1E9:.6} Gbps")
+            print("|----------------------------------------")
+
+            time.sleep(1)
+            prev_rx_bytes = rx_bytes
+            prev_tx_bytes = tx_bytes
 
 
 if __name__ == "__main__":
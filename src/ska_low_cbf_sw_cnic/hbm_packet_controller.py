@@ -12,17 +12,34 @@ HBM Packet Controller ICL (abstraction)
 """
 
 import bisect
+import itertools
+import logging
 import math
+import mmap
+import threading
 import time
 import typing
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
+import dpkt
 import numpy as np
 from ska_low_cbf_fpga import FpgaPeripheral, IclField
 from ska_low_cbf_fpga.args_fpga import str_from_int_bytes
 
-from ska_low_cbf_sw_cnic.pcap import get_reader, get_writer
-from ska_low_cbf_sw_cnic.ptp_scheduler import TIMESTAMP_BITS, unix_ts_from_ptp
+from ska_low_cbf_sw_cnic.pcap import (
+    PCAP_RECORD_HEADER_SIZE,
+    PCAPNG_EPB_HEADER_SIZE,
+    WRITE_BUFFER_SIZE,
+    frame_spans,
+    get_writer,
+    pcapng_block_headers,
+    pcapng_block_size,
+    preallocate,
+    uniform_pcap_records,
+)
+from ska_low_cbf_sw_cnic.ptp_scheduler import TIMESTAMP_BITS, TIMESTAMP_NS_BITS
 
 # These sizes are all in Bytes
 IFG_SIZE = 20  # Ethernet Inter-Frame Gap
@@ -32,16 +49,99 @@ BEAT_SIZE = 64
 MEM_ALIGN_SIZE = 64  # data in HBM aligned to multiples of this
 TIMESTAMP_SIZE = TIMESTAMP_BITS // 8
 
+RX_SLEEP_TIME = 5
+"""wait at most this many seconds between checking if Rx is finished"""
+RX_MIN_SLEEP_TIME = 0.1
+"""wait at least this many seconds between checking if Rx is finished"""
+RX_PROGRESS_INTERVAL = 60
+"""log Rx progress this often (seconds) while waiting for completion"""
+LOAD_BATCH_SIZE = 64 << 20
+"""gather (up to) this many Bytes of packets before writing them to HBM"""
+HBM_READ_SIZE = 64 << 20
+"""read received packets from HBM in pieces of (up to) this many Bytes"""
+
 
 def _get_padded_size(data_size: int) -> int:
     """
     Round up the packet size to the next 'beat's worth of data
     :param data_size: bytes
     """
-    pad_length = 0
-    if data_size % MEM_ALIGN_SIZE:
-        pad_length = MEM_ALIGN_SIZE - (data_size % MEM_ALIGN_SIZE)
-    return data_size + pad_length
+    # MEM_ALIGN_SIZE is a power of 2, so we can round up with a mask
+    return (data_size + MEM_ALIGN_SIZE - 1) & -MEM_ALIGN_SIZE
+
+
+def _decode_ptp_timestamps(
+    rows: np.ndarray, offset: int
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the 80 bit big-endian PTP timestamps of packets read from HBM
+    :param rows: 2D array, one packet (& timestamp) per row
+    :param offset: offset of timestamp within each row
+    :return: seconds, nanoseconds fields of each timestamp (uint64)
+    """
+    ptp = rows[:, offset : offset + TIMESTAMP_SIZE]
+    ns_size = TIMESTAMP_NS_BITS // 8
+    seconds_bytes = np.zeros((len(rows), 8), dtype=np.uint8)
+    seconds_bytes[:, 8 - TIMESTAMP_SIZE + ns_size :] = ptp[:, :-ns_size]
+    seconds = seconds_bytes.view(">u8")[:, 0].astype(np.uint64)
+    nanoseconds = (
+        np.ascontiguousarray(ptp[:, -ns_size:])
+        .view(">u4")[:, 0]
+        .astype(np.uint64)
+    )
+    return seconds, nanoseconds
+
+
+def _stage_packets(
+    packets: np.ndarray, staging: np.ndarray
+) -> typing.Iterator[int]:
+    """
+    Copy packets into the rows of a staging buffer, a batch at a time
+    :param packets: 2D array, one packet per row
+    :param staging: 2D array, one (padded) packet per row
+    :return: iterator of number of rows filled, each time the staging buffer
+    is full (or the packets run out)
+    """
+    for start in range(0, len(packets), len(staging)):
+        batch = packets[start : start + len(staging)]
+        staging[: len(batch), : packets.shape[1]] = batch
+        yield len(batch)
+
+
+def _stage_frames(
+    buf,
+    spans: typing.Iterable[typing.Tuple[int, int]],
+    packet_size: int,
+    staging: np.ndarray,
+) -> typing.Iterator[int]:
+    """
+    Copy packets from an in-memory PCAP(NG) file into the rows of a staging
+    buffer, one at a time.
+    :param buf: buffer holding the whole file (e.g. an mmap)
+    :param spans: (offset, length) of each packet in buf, c.f. frame_spans
+    :param packet_size: size of every packet
+    :param staging: 2D array, one (padded) packet per row
+    :return: as per _stage_packets
+    :raises ValueError: if a packet is not packet_size Bytes
+    """
+    batch_rows, row_size = staging.shape
+    n_rows = 0
+    # memoryview slices are cheaper to make than ndarray views
+    # (released on exit, so they don't stop buf from being closed)
+    with memoryview(buf) as buf_view, memoryview(
+        staging.reshape(-1)
+    ) as staging_view:
+        for offset, length in spans:
+            start = n_rows * row_size
+            staging_view[start : start + packet_size] = buf_view[
+                offset : offset + length
+            ]
+            n_rows += 1
+            if n_rows == batch_rows:
+                yield n_rows
+                n_rows = 0
+    if n_rows:
+        yield n_rows
 
 
 def _gap_from_rate(packet_size: int, rate: float, burst_size: int = 1) -> int:
@@ -59,6 +159,21 @@ def _gap_from_rate(packet_size: int, rate: float, burst_size: int = 1) -> int:
     return math.ceil(1e9 * burst_size / packet_rate)
 
 
+def _rx_poll_interval(remaining: int, rate: float) -> float:
+    """
+    Choose how long to wait before checking Rx progress again.
+    Poll slowly while lots of packets are still to come, then faster as
+    the expected completion time approaches.
+    :param remaining: number of packets still to be received
+    :param rate: recent packet reception rate (packets/second)
+    :return: seconds
+    """
+    if rate <= 0:
+        return RX_SLEEP_TIME
+    # aim for half the expected time to completion
+    return min(RX_SLEEP_TIME, max(RX_MIN_SLEEP_TIME, remaining / rate / 2))
+
+
 class HbmPacketController(FpgaPeripheral):
     """
     Class to represent an HbmPacketController FPGA Peripheral
@@ -76,12 +191,17 @@ class HbmPacketController(FpgaPeripheral):
         ]
         # convert sizes to a list of virtual end addresses of each buffer
         # e.g. [1000, 1000, 1000] => [1000, 2000, 3000]
-        hbm_end_addresses = np.cumsum(hbm_sizes)
+        # (a list of ints, as bisect is faster on a list than an ndarray)
+        hbm_end_addresses = np.cumsum(hbm_sizes).tolist()
         # insert a zero for the first buffer's start address:
         # [0, 1000, 2000, 3000]
-        self._buffer_offsets = np.insert(hbm_end_addresses, 0, 0)
+        self._buffer_offsets = [0] + hbm_end_addresses
         """Virtual addresses of start/end of each HBM buffer
         (Note: n+1 elements, last element is end of last buffer)"""
+        self._uniform_buffer_size = (
+            hbm_sizes[0] if len(set(hbm_sizes)) == 1 else None
+        )
+        """Size of every HBM buffer, if they are all the same (else None)"""
         self._loaded_pcap = None
         """Filename of the pcap file loaded to HBM"""
 
@@ -116,8 +236,15 @@ class HbmPacketController(FpgaPeripheral):
         # (would need to add an offset if this was not the case)
         # e.g. if _buffer_offsets is [0, 1000, 2000, 3000]
         # address 50 will return 1; address 1500 will return 2
-        start_buffer = bisect.bisect(self._buffer_offsets, address)
-        end_buffer = bisect.bisect(self._buffer_offsets, address + len(data))
+        if self._uniform_buffer_size:
+            # same result as bisect, when all buffers are the same size
+            start_buffer = address // self._uniform_buffer_size + 1
+            end_buffer = (address + len(data)) // self._uniform_buffer_size + 1
+        else:
+            start_buffer = bisect.bisect(self._buffer_offsets, address)
+            end_buffer = bisect.bisect(
+                self._buffer_offsets, address + len(data)
+            )
         if end_buffer >= len(self._buffer_offsets):
             raise IndexError(
                 f"Cannot fit {len(data)} bytes "
@@ -125,23 +252,61 @@ class HbmPacketController(FpgaPeripheral):
                 f"Buffers end at {self._buffer_offsets[-1]}."
             )
 
-        start_offset = address - self._buffer_offsets[start_buffer - 1]
-        if start_buffer == end_buffer:
-            # the easy case - everything in one buffer
-            self._fpga_interface.write_memory(start_buffer, data, start_offset)
-        else:
-            # split across buffers, assuming buffer size >> data size
-            # how much room is left in the first buffer?
-            first_size = (  # calculate buffer size from address map
-                self._buffer_offsets[start_buffer]
-                - self._buffer_offsets[start_buffer - 1]
-            ) - start_offset
-            self._fpga_interface.write_memory(
-                start_buffer, data[:first_size], start_offset
-            )
-            self._fpga_interface.write_memory(
-                start_buffer + 1, data[first_size:], 0
-            )
+        offset = address - self._buffer_offsets[start_buffer - 1]
+        # split across as many buffers as needed
+        for buffer in range(start_buffer, end_buffer + 1):
+            # how much room is left in this buffer?
+            size = (  # calculate buffer size from address map
+                self._buffer_offsets[buffer] - self._buffer_offsets[buffer - 1]
+            ) - offset
+            self._fpga_interface.write_memory(buffer, data[:size], offset)
+            data = data[size:]
+            offset = 0
+
+    def wait_rx_complete(
+        self,
+        cancel: threading.Event,
+        timeout: typing.Union[float, None] = None,
+    ) -> bool:
+        """
+        Wait for the FPGA to finish receiving packets.
+        There is no completion interrupt available to us, so this polls the
+        status registers (see _rx_poll_interval).
+        :param cancel: stop waiting as soon as this is set
+        :param timeout: give up after this many seconds (None: wait forever)
+        :return: True if reception is complete
+        """
+        # constant while we wait, so only read it once
+        n_packets = self.rx_packets_to_capture.value
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        last_count = 0
+        last_time = start_time = last_report = time.monotonic()
+        while not self.rx_complete.value:
+            count = self.rx_packet_count.value
+            if count >= n_packets:
+                break
+            now = time.monotonic()
+            # (zero if nothing arrived, backing off to RX_SLEEP_TIME)
+            rate = (count - last_count) / max(now - last_time, 1e-9)
+            last_count, last_time = count, now
+            wait = _rx_poll_interval(n_packets - count, rate)
+            if timeout is not None:
+                wait = min(wait, start_time + timeout - now)
+                if wait <= 0:
+                    return False
+            if debug:
+                self._logger.debug(
+                    f"Rx wait: {count}/{n_packets} packets, "
+                    f"next poll in {wait:.1f} s"
+                )
+            elif now - last_report >= RX_PROGRESS_INTERVAL:
+                self._logger.info(
+                    f"Waiting for Rx, {count}/{n_packets} packets received"
+                )
+                last_report = now
+            if cancel.wait(timeout=wait):
+                return False
+        return True
 
     def dump_pcap(self, out_filename: str, packet_size: int):
         """
@@ -151,7 +316,7 @@ class HbmPacketController(FpgaPeripheral):
         :return:
         """
         self._logger.info(f"Writing to {out_filename}")
-        with open(out_filename, "wb") as out_file:
+        with open(out_filename, "wb", buffering=WRITE_BUFFER_SIZE) as out_file:
             self._dump_pcap(out_file, packet_size)
 
     def _dump_pcap(
@@ -177,103 +342,181 @@ class HbmPacketController(FpgaPeripheral):
             padded_timestamp_size = _get_padded_size(TIMESTAMP_SIZE)
             data_chunk_size += padded_timestamp_size
 
-        last_partial_packet = None
-        n_packets = 0
+        # register values are fixed now the capture is finished, read them
+        # up front rather than while the HBM reader thread is busy
+        capture_limit = self.rx_packets_to_capture.value
+        buffer_ends = []
         # start from 1 as our first buffer is #1
         for buffer in range(1, len(self._buffer_offsets)):
             # skipping buffers for debugging
             if not self._rx_buffer_enabled(buffer):
                 self._logger.debug(f"Skipping buffer {buffer}")
                 continue
-
             end = getattr(self, f"rx_hbm_{buffer}_end_addr").value
-            self._logger.info(f"Reading {end} B from HBM buffer {buffer} ")
             if end == 0:
                 # No data in this buffer,
                 # so we have already processed the last packet
                 break
+            buffer_ends.append((buffer, end))
+
+        # PCAP(NG) records are assembled in a reusable block & written in
+        # one go, rather than handing dpkt one packet at a time
+        pcapng = isinstance(writer, dpkt.pcapng.Writer)
+        if pcapng:
+            header_size = PCAPNG_EPB_HEADER_SIZE
+            record_size = pcapng_block_size(packet_size)
+        else:
+            header_size = PCAP_RECORD_HEADER_SIZE
+            record_size = header_size + packet_size
+        rows_per_block = max(WRITE_BUFFER_SIZE // record_size, 1)
+        # no more packets than HBM holds, however high the capture limit
+        max_packets = sum(end for _, end in buffer_ends) // data_chunk_size + 1
+        preallocate(out_file, min(capture_limit, max_packets) * record_size)
+        # zeroed, as pcapng blocks pad the data out to a multiple of 4 Bytes
+        block = np.zeros((rows_per_block, record_size), dtype=np.uint8)
+        if pcapng:
+            # pcapng blocks end with a repeat of the block length
+            block[:, -4:] = np.array([record_size], dtype="=u4").view(np.uint8)
+
+        # buffers are read piece by piece, so memory use doesn't grow with
+        # the size of the HBM buffers: (buffer, start, end) of each piece
+        pieces = [
+            (buffer, start, min(start + HBM_READ_SIZE, end))
+            for buffer, end in buffer_ends
+            for start in range(0, end, HBM_READ_SIZE)
+        ]
 
-            # WORKAROUND for weird bug when reading 2GB+ on some machines
-            # hopefully we can remove this later
-            raw = np.empty(end, dtype=np.uint8)
-            page_size = 1 << 30  # read 1GB
-            for this_read_start in range(0, end, page_size):
-                this_read_end = min(this_read_start + page_size, end)
-                n_bytes = this_read_end - this_read_start
-                raw[this_read_start:this_read_end] = (
-                    self._interfaces[self._default_interface]
-                    .read_memory(buffer, n_bytes, this_read_start)
-                    .view(dtype=np.uint8)
-                )
-                print(".", end="", flush=True)
-            print("")
-            # END WORKAROUND
-            # below is the code that would work if not for the bug!
-            # raw = (
-            #     self._interfaces[self._default_interface]
-            #     .read_memory(buffer, end)
-            #     .view(dtype=np.uint8)
-            # )
-            self._logger.info(f"Writing buffer {buffer} packets to file")
-
-            if last_partial_packet is not None:
-                # insert tail of last buffer into head of this one
-                raw = np.insert(raw, 0, last_partial_packet)
-
-            # ensure number of data bytes is an integer multiple of
-            # data_chunk_size, by discarding the remainder from the end
-            if raw.nbytes % data_chunk_size:
-                discard_bytes = raw.nbytes % data_chunk_size
-                # save the partial packet for next loop
-                last_partial_packet = raw[-discard_bytes:]
-                raw = raw[:-discard_bytes]
-            else:
-                last_partial_packet = None
-
-            raw.shape = (raw.nbytes // data_chunk_size, data_chunk_size)
-            for data in raw:
-                if timestamped:
-                    packet_data = data[:packet_size].tobytes()
-                    timestamp = unix_ts_from_ptp(
-                        int.from_bytes(
-                            data[
-                                padded_packet_size : padded_packet_size
-                                + TIMESTAMP_SIZE
-                            ].tobytes(),
-                            "big",
+        # two read buffers, reused for every piece:
+        # one is filled from HBM while the other is written to disk
+        piece_size = max((end - start for _, start, end in pieces), default=0)
+        read_buffers = [
+            np.empty(data_chunk_size + piece_size, dtype=np.uint8)
+            for _ in range(2)
+        ]
+
+        # any partial packet at the end of a piece is copied out, as it must
+        # survive the next read into the same buffer
+        partial_packet = np.empty(data_chunk_size, dtype=np.uint8)
+        partial_size = 0
+        n_packets = 0
+        first_ts = timestamp = None  # of the first & last packets written
+        capture_complete = False
+        try:
+            # read the next piece from HBM while writing this one to disk
+            with ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="hbm_read"
+            ) as hbm_reader:
+                next_read = None
+                for index, (buffer, start, end) in enumerate(pieces):
+                    if start == 0:
+                        self._logger.info(
+                            f"Writing buffer {buffer} packets to file"
                         )
+                    if next_read is None:
+                        next_read = hbm_reader.submit(
+                            self._read_rx_buffer,
+                            buffer,
+                            end,
+                            data_chunk_size,
+                            start,
+                            read_buffers[index % 2],
+                        )
+                    raw = next_read.result()
+                    next_read = None
+
+                    # insert tail of last piece into head of this one,
+                    # using the space reserved in front of the data read
+                    head = data_chunk_size - partial_size
+                    raw[head:data_chunk_size] = partial_packet[:partial_size]
+                    raw = raw[head:]
+
+                    # don't read ahead if this piece completes the capture
+                    if (
+                        index + 1 < len(pieces)
+                        and n_packets + raw.nbytes // data_chunk_size
+                        < capture_limit
+                    ):
+                        next_buffer, next_start, next_end = pieces[index + 1]
+                        next_read = hbm_reader.submit(
+                            self._read_rx_buffer,
+                            next_buffer,
+                            next_end,
+                            data_chunk_size,
+                            next_start,
+                            read_buffers[(index + 1) % 2],
+                        )
+
+                    # ensure number of data bytes is an integer multiple of
+                    # data_chunk_size, by discarding the remainder from the end
+                    partial_size = raw.nbytes % data_chunk_size
+                    if partial_size:
+                        # save the partial packet for next loop
+                        partial_packet[:partial_size] = raw[-partial_size:]
+                        raw = raw[:-partial_size]
+
+                    raw.shape = (
+                        raw.nbytes // data_chunk_size,
+                        data_chunk_size,
                     )
-                    writer.writepkt(packet_data, timestamp)
-                    if n_packets == 0:
-                        first_ts = timestamp
-                else:
-                    writer.writepkt(data[:packet_size].tobytes())
-                n_packets += 1
-                # stop at rx_packets_to_capture could/should be done in FPGA?
-                if n_packets >= self.rx_packets_to_capture:
-                    break
-            else:
-                continue
-            break
-            # end stop at rx_packets_to_capture logic
-        # end for each buffer loop
+                    n_rows = len(raw)
+                    # stop at rx_packets_to_capture
+                    # could/should be done in FPGA?
+                    if n_rows and n_packets + n_rows >= capture_limit:
+                        n_rows = max(capture_limit - n_packets, 1)
+                        capture_complete = True
+
+                    for start in range(0, n_rows, rows_per_block):
+                        rows = raw[start : min(start + rows_per_block, n_rows)]
+                        seconds, nanoseconds = self._packet_times(
+                            rows, padded_packet_size, timestamped
+                        )
+                        if pcapng:
+                            headers = pcapng_block_headers(
+                                seconds, nanoseconds, packet_size
+                            )
+                        else:
+                            # fields: seconds, ns, captured & original length
+                            headers = np.empty((len(rows), 4), dtype="=u4")
+                            headers[:, 0] = seconds
+                            headers[:, 1] = nanoseconds
+                            headers[:, 2:] = packet_size
+                        records = block[: len(rows)]
+                        records[:, :header_size] = headers.view(np.uint8)
+                        records[
+                            :, header_size : header_size + packet_size
+                        ] = rows[:, :packet_size]
+                        out_file.write(records)
+                        # only the ends are needed for the duration log
+                        timestamps = self._packet_timestamps(
+                            rows[[0, -1]], padded_packet_size, timestamped
+                        )
+                        if n_packets == 0:
+                            first_ts = timestamps[0]
+                        timestamp = timestamps[-1]
+                        n_packets += len(rows)
+                    if capture_complete:
+                        break
+                # end for each buffer loop
+        finally:
+            # discard any space preallocated for packets we didn't get,
+            # even if the dump failed part way through
+            out_file.truncate()
         self._logger.info(f"Finished writing {n_packets} packets")
         total_bytes = n_packets * packet_size
-        if timestamped:
-            try:
-                duration = float(timestamp - first_ts)
-                self._logger.info(f"Capture duration {duration:.9f} s")
-                # guard against divide by zero
-                # when PTP isn't active it marks all packets at t=0
-                if duration > 0:
-                    data_rate_gbps = (8 * total_bytes / duration) / 1e9
-                    self._logger.info(
-                        f"Average data rate {data_rate_gbps:.3f} Gbps"
-                    )
-                else:
-                    self._logger.warning("Cannot calculate data rate")
-            except NameError:
-                self._logger.error("Couldn't calculate duration of capture")
+        if timestamped and first_ts is None:
+            self._logger.error("Couldn't calculate duration of capture")
+        elif timestamped:
+            duration = float(timestamp - first_ts)
+            self._logger.info(f"Capture duration {duration:.9f} s")
+            # guard against divide by zero
+            # when PTP isn't active it marks all packets at t=0
+            if duration > 0:
+                data_rate_gbps = (8 * total_bytes / duration) / 1e9
+                self._logger.info(
+                    f"Average data rate {data_rate_gbps:.3f} Gbps"
+                )
+            else:
+                self._logger.warning("Cannot calculate data rate")
         self._logger.info(
             (
                 f"Wrote {n_packets} packets, "
@@ -282,6 +525,98 @@ class HbmPacketController(FpgaPeripheral):
             )
         )
 
+    @staticmethod
+    def _packet_timestamps(
+        rows: np.ndarray, padded_packet_size: int, timestamped: bool
+    ) -> list:
+        """
+        Get the timestamps of packets read from HBM
+        :param rows: 2D array, one packet (& timestamp) per row
+        :param padded_packet_size: offset of timestamp within each row
+        :param timestamped: does the data in HBM contain timestamps?
+        (if not, the current time is used)
+        :return: Unix timestamp of each packet
+        """
+        if not timestamped:
+            return [time.time()] * len(rows)
+        seconds, nanoseconds = _decode_ptp_timestamps(rows, padded_packet_size)
+        # as per unix_ts_from_ptp, from the already-split fields
+        ns_per_second = Decimal(1e9)
+        return [
+            second + Decimal(nanosecond) / ns_per_second
+            for second, nanosecond in zip(
+                seconds.tolist(), nanoseconds.tolist()
+            )
+        ]
+
+    @staticmethod
+    def _packet_times(
+        rows: np.ndarray, padded_packet_size: int, timestamped: bool
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the timestamps of packets read from HBM, for PCAP record headers
+        :param rows: 2D array, one packet (& timestamp) per row
+        :param padded_packet_size: offset of timestamp within each row
+        :param timestamped: does the data in HBM contain timestamps?
+        (if not, the current time is used)
+        :return: Unix seconds, nanoseconds of each packet
+        """
+        if not timestamped:
+            now = time.time()
+            seconds = np.full(len(rows), int(now), dtype=np.uint64)
+            nanoseconds = np.full(
+                len(rows), int(now % 1 * 1_000_000_000), dtype=np.uint64
+            )
+            return seconds, nanoseconds
+        seconds, nanoseconds = _decode_ptp_timestamps(rows, padded_packet_size)
+        # as per unix_ts_from_ptp, any whole seconds in ns field carry over
+        seconds += nanoseconds // 1_000_000_000
+        nanoseconds %= 1_000_000_000
+        return seconds, nanoseconds
+
+    def _read_rx_buffer(
+        self,
+        buffer: int,
+        end: int,
+        headroom: int = 0,
+        start: int = 0,
+        out: typing.Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Read received data from an HBM buffer
+        :param buffer: Buffer index, starting from 1
+        :param end: Byte address to read up to
+        :param headroom: number of unused Bytes to reserve at the start of
+        the returned array (so data can be prepended without a copy)
+        :param start: Byte address to start reading from
+        :param out: uint8 array to read into (instead of allocating one),
+        must have room for headroom + end - start Bytes
+        """
+        self._logger.debug(
+            f"Reading {end - start} B from HBM buffer {buffer} at {start}"
+        )
+        # WORKAROUND for weird bug when reading 2GB+ on some machines
+        # hopefully we can remove this later
+        if out is None:
+            raw = np.empty(headroom + end - start, dtype=np.uint8)
+        else:
+            raw = out[: headroom + end - start]
+        data = raw[headroom:]
+        read_memory = self._fpga_interface.read_memory
+        page_size = 1 << 30  # read 1GB
+        for this_read_start in range(0, end - start, page_size):
+            this_read_end = min(this_read_start + page_size, end - start)
+            n_bytes = this_read_end - this_read_start
+            data[this_read_start:this_read_end] = read_memory(
+                buffer, n_bytes, start + this_read_start
+            ).view(dtype=np.uint8)
+        # END WORKAROUND
+        # below is the code that would work if not for the bug!
+        # raw = self._fpga_interface.read_memory(
+        #     buffer, end - start, start
+        # ).view(dtype=np.uint8)
+        return raw
+
     @property
     def loaded_pcap(self) -> IclField[str]:
         """Get our last loaded PCAP file name"""
@@ -311,19 +646,23 @@ class HbmPacketController(FpgaPeripheral):
         :param in_file: input PCAP(NG) file
         :raises RuntimeError: if FPGA settings don't match PCAP file
         """
-        reader = get_reader(in_file)
-        first_packet = True
-        virtual_address = 0  # byte address to write to
-        packet_padded_size = 0
-        dot_print_increment = 128 << 20  # print progress every 128MiB
-        print_next_dot = 0
-        n_packets = 0
-        packet_size = 0
-        for timestamp, packet in reader:
-            # assess first packet,
-            # firmware assumes all packets are same size
-            if first_packet:
-                packet_size = len(packet)
+        # packets are copied straight from the page cache to our HBM write
+        # buffer
+        file_map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = packets = batches = None
+        try:
+            if hasattr(file_map, "madvise"):  # Python 3.8+
+                file_map.madvise(mmap.MADV_SEQUENTIAL)
+            virtual_address = 0  # byte address to write to
+            progress_increment = 128 << 20  # log progress every 128MiB
+            next_progress = progress_increment
+            n_packets = 0
+            spans = frame_spans(file_map)
+            first_span = next(spans, None)
+            if first_span is not None:
+                # assess first packet,
+                # firmware assumes all packets are same size
+                packet_size = first_span[1]
                 if packet_size != self.tx_packet_size:
                     raise RuntimeError(
                         "Packet size mismatch! Configured in FPGA: "
@@ -331,30 +670,69 @@ class HbmPacketController(FpgaPeripheral):
                         f"PCAP file contains: {packet_size}."
                     )
                 packet_padded_size = _get_padded_size(packet_size)
-                first_packet = False
-                padded_packet = np.zeros(packet_padded_size, dtype=np.uint8)
+                # _virtual_write needs the last packet to end before
+                # the end of the last buffer
+                max_packets = (
+                    self._buffer_offsets[-1] - 1
+                ) // packet_padded_size
+                # padded packets are gathered in a staging buffer & written
+                # to HBM in large batches (one FPGA write per batch, not per
+                # packet). Padding stays zero, as every batch has packets at
+                # the same offsets within the staging buffer
+                staging = np.zeros(
+                    (
+                        max(LOAD_BATCH_SIZE // packet_padded_size, 1),
+                        packet_padded_size,
+                    ),
+                    dtype=np.uint8,
+                )
 
-            # TODO do we need to check that it's a valid ethernet packet?
-            #  - and verify the length?
+                # TODO do we need to check that it's a valid ethernet packet?
+                #  - and verify the length?
 
-            padded_packet[:packet_size] = np.frombuffer(packet, dtype=np.uint8)
-            try:
-                self._virtual_write(padded_packet, virtual_address)
-            except IndexError:
-                # stop if we don't have enough memory left for the packet
-                self._logger.debug(
-                    f"Aborting load, {padded_packet.nbytes} B can't fit at"
-                    f" virtual address {virtual_address}"
-                )
-                break
-            n_packets += 1
-            virtual_address += packet_padded_size
-            if virtual_address >= print_next_dot:
-                print(".", end="", flush=True)
-                print_next_dot += dot_print_increment
-            if n_packets % 1000 == 0:
-                # brief sleep to give the control system a chance to do things
-                time.sleep(0.0001)
+                records = uniform_pcap_records(file_map)
+                if records is not None:
+                    # all the same size, copy a whole batch at a time
+                    packets = records[:, PCAP_RECORD_HEADER_SIZE:]
+                    batches = _stage_packets(packets[:max_packets], staging)
+                else:
+                    spans = itertools.chain([first_span], spans)
+                    batches = _stage_frames(
+                        file_map,
+                        itertools.islice(spans, max_packets),
+                        packet_size,
+                        staging,
+                    )
+                for n_staged in batches:
+                    self._virtual_write(
+                        staging[:n_staged].reshape(-1), virtual_address
+                    )
+                    n_packets += n_staged
+                    virtual_address += n_staged * packet_padded_size
+                    if virtual_address >= next_progress:
+                        self._logger.debug(
+                            f"Loaded {str_from_int_bytes(virtual_address)}"
+                        )
+                        next_progress += progress_increment
+                    # brief sleep to give the control system a chance to do
+                    # things
+                    time.sleep(0.0001)
+                if records is not None:
+                    truncated = len(records) > max_packets
+                else:
+                    truncated = next(spans, None) is not None
+                if truncated:
+                    # stopped as we don't have enough memory left for the
+                    # packet
+                    self._logger.debug(
+                        f"Aborting load, {packet_padded_size} B can't fit at"
+                        f" virtual address {virtual_address}"
+                    )
+        finally:
+            # drop our views of the file, so it can be unmapped now rather
+            # than whenever they are garbage collected
+            records = packets = batches = None
+            file_map.close()
 
         self._logger.info(
             f"Loaded {n_packets} packets, "
@@ -390,27 +768,29 @@ class HbmPacketController(FpgaPeripheral):
         if burst_size != 1:
             warnings.warn("Packet burst not tested!")
 
-        if burst_gap:
-            self.tx_burst_gap = burst_gap
-        else:
-            self.tx_burst_gap = _gap_from_rate(packet_size, rate, burst_size)
+        # values are calculated locally rather than read back from registers
+        if not burst_gap:
+            burst_gap = _gap_from_rate(packet_size, rate, burst_size)
             self._logger.info(
                 (
                     f"{rate} Gbps with {packet_size} B packets "
                     f"in bursts of {burst_size} "
-                    f"gives a burst period of {self.tx_burst_gap.value} ns"
+                    f"gives a burst period of {burst_gap} ns"
                 )
             )
+        self.tx_burst_gap = burst_gap
 
         self.tx_packet_size = packet_size
         self.tx_packet_to_send = n_packets
         self.tx_packets_per_burst = burst_size
-        self.tx_bursts = math.ceil(n_packets / burst_size)
+        # (integer ceiling division, exact for any number of packets)
+        self.tx_bursts = -(-n_packets // burst_size)
         packet_padded_size = _get_padded_size(packet_size)
-        self.tx_beats_per_packet = packet_padded_size // BEAT_SIZE
-        self.tx_beats_per_burst = self.tx_beats_per_packet * burst_size
-        self.tx_axi_transactions = math.ceil(
-            (n_packets * packet_padded_size) / AXI_TRANSACTION_SIZE
+        beats_per_packet = packet_padded_size // BEAT_SIZE
+        self.tx_beats_per_packet = beats_per_packet
+        self.tx_beats_per_burst = beats_per_packet * burst_size
+        self.tx_axi_transactions = -(
+            -(n_packets * packet_padded_size) // AXI_TRANSACTION_SIZE
         )
 
         self.tx_loop_enable = n_loops > 1
@@ -7,11 +7,41 @@
 """
 PCAP Processing Helper Functions
 """
+import functools
+import mmap
 import os
+import struct
 import time
 import typing
 
 import dpkt
+import numpy as np
+
+PCAP_HEADER_SIZE = 24
+"""PCAP global (file) header size (Bytes)"""
+PCAP_RECORD_HEADER_SIZE = 16
+"""PCAP per-packet record header size (Bytes)"""
+PCAP_RECORD_HEADER = struct.Struct("=IIII")
+"""PCAP record header, in the native byte order used by dpkt.pcap.Writer:
+seconds, sub-seconds, captured length, original length"""
+READ_BUFFER_SIZE = 1024 * 1024
+"""Buffer size to use when streaming PCAP files in (Bytes)"""
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+"""Buffer size to use when writing PCAP files (Bytes)"""
+PCAP_BYTE_ORDER = {
+    b"\xd4\xc3\xb2\xa1": "<",  # microsecond timestamps
+    b"\x4d\x3c\xb2\xa1": "<",  # nanosecond timestamps
+    b"\xa1\xb2\xc3\xd4": ">",
+    b"\xa1\xb2\x3c\x4d": ">",
+}
+"""PCAP magic number => struct byte order character"""
+_PCAPNG_SHB_TYPE = b"\x0a\x0d\x0d\x0a"
+_PCAPNG_BYTE_ORDER_MAGIC_LE = b"\x4d\x3c\x2b\x1a"
+_PCAPNG_SIMPLE_PACKET_BLOCK = 3
+_PCAPNG_ENHANCED_PACKET_BLOCK = 6
+PCAPNG_EPB_HEADER_SIZE = 28
+"""PCAPNG Enhanced Packet Block header size (Bytes): block type, length,
+interface, timestamp high & low, captured & original length"""
 
 
 def get_reader(
@@ -21,6 +51,79 @@ def get_reader(
     return dpkt.pcap.UniversalReader(file)
 
 
+def advise_sequential(in_file: typing.BinaryIO) -> None:
+    """
+    Tell the kernel we will read a file from start to end, so it can read
+    ahead more aggressively. Best effort only.
+    :param in_file: file to be read
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(in_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass  # e.g. a pipe
+
+
+def frame_spans(buf) -> typing.Iterator[typing.Tuple[int, int]]:
+    """
+    Locate each packet in an in-memory PCAP(NG) file, without copying or
+    parsing the packets themselves.
+    :param buf: buffer holding the whole file (e.g. an mmap)
+    :return: iterator of (offset, length) of each packet's data within buf
+    :raises ValueError: if buf doesn't contain a PCAP(NG) file
+    """
+    magic = bytes(buf[:4])
+    if magic in PCAP_BYTE_ORDER:
+        record_header = struct.Struct(PCAP_BYTE_ORDER[magic] + "IIII")
+        offset = PCAP_HEADER_SIZE
+        while offset + PCAP_RECORD_HEADER_SIZE <= len(buf):
+            _, _, captured_length, _ = record_header.unpack_from(buf, offset)
+            offset += PCAP_RECORD_HEADER_SIZE
+            if offset + captured_length > len(buf):
+                break  # truncated file
+            yield offset, captured_length
+            offset += captured_length
+    elif magic == _PCAPNG_SHB_TYPE:
+        yield from _pcapng_frame_spans(buf)
+    else:
+        raise ValueError(f"Not a PCAP(NG) file, magic number: {magic.hex()}")
+
+
+def _pcapng_frame_spans(buf) -> typing.Iterator[typing.Tuple[int, int]]:
+    """
+    Locate each packet in an in-memory PCAPNG file.
+    See frame_spans.
+    """
+    offset = 0
+    byte_order = "<"
+    while offset + 12 <= len(buf):
+        if bytes(buf[offset : offset + 4]) == _PCAPNG_SHB_TYPE:
+            # each section header sets the byte order for its section
+            if bytes(buf[offset + 8 : offset + 12]) == (
+                _PCAPNG_BYTE_ORDER_MAGIC_LE
+            ):
+                byte_order = "<"
+            else:
+                byte_order = ">"
+        block_type, block_length = struct.unpack_from(
+            byte_order + "II", buf, offset
+        )
+        if block_length < 12:
+            raise ValueError(f"Corrupt PCAPNG block at offset {offset}")
+        if block_type == _PCAPNG_ENHANCED_PACKET_BLOCK:
+            (captured_length,) = struct.unpack_from(
+                byte_order + "I", buf, offset + 20
+            )
+            yield offset + 28, captured_length
+        elif block_type == _PCAPNG_SIMPLE_PACKET_BLOCK:
+            (original_length,) = struct.unpack_from(
+                byte_order + "I", buf, offset + 8
+            )
+            yield offset + 12, min(original_length, block_length - 16)
+        offset += block_length
+
+
 def _writepkt_patch(self, pkt, ts):
     """
     Monkey-patch to convert timestamps to floats before writing.
@@ -30,6 +133,65 @@ def _writepkt_patch(self, pkt, ts):
     self._original_writepkt(pkt, float(ts))
 
 
+def pcapng_block_size(packet_size: int) -> int:
+    """
+    Get the size of the PCAPNG Enhanced Packet Block dpkt writes for a packet
+    :param packet_size: packet size (Bytes)
+    :return: block size (Bytes), including padding & trailing length
+    """
+    return PCAPNG_EPB_HEADER_SIZE + ((packet_size + 3) & -4) + 4
+
+
+def pcapng_block_headers(
+    seconds: np.ndarray, nanoseconds: np.ndarray, packet_size: int
+) -> np.ndarray:
+    """
+    Create PCAPNG Enhanced Packet Block headers, as dpkt.pcapng.Writer would
+    :param seconds: Unix seconds of each packet
+    :param nanoseconds: nanoseconds of each packet
+    :param packet_size: packet size (Bytes)
+    :return: 2D array of native-endian 32-bit words, one header per row
+    """
+    # dpkt converts the timestamp to a float & rounds microseconds from that
+    exact = (seconds + nanoseconds / 1e9) * 1e6
+    microseconds = np.rint(exact)
+    # between 0 & 2**20 s the float sum above can be 1 ulp away from a float
+    # made directly from the timestamp. That only changes the result when
+    # rounding a near-tie, so convert just those (rare) values exactly
+    near_tie = np.abs(exact - np.floor(exact) - 0.5) < 1e-3
+    for index in np.flatnonzero((seconds < 1 << 20) & near_tie):
+        total_ns = int(seconds[index]) * 1_000_000_000 + int(
+            nanoseconds[index]
+        )
+        microseconds[index] = round(total_ns / 1_000_000_000 * 1e6)
+    microseconds = microseconds.astype(np.uint64)
+    headers = np.empty((len(microseconds), 7), dtype="=u4")
+    headers[:, 0] = _PCAPNG_ENHANCED_PACKET_BLOCK
+    headers[:, 1] = pcapng_block_size(packet_size)
+    headers[:, 2] = 0  # interface ID
+    headers[:, 3] = microseconds >> np.uint64(32)
+    headers[:, 4] = microseconds & np.uint64(0xFFFFFFFF)
+    headers[:, 5:] = packet_size
+    return headers
+
+
+def preallocate(out_file: typing.BinaryIO, size: int) -> None:
+    """
+    Reserve disk space for data we are about to write, so the filesystem
+    doesn't have to keep extending the file. Best effort only.
+    Note the file size grows to include the reserved space, truncate the
+    file afterwards if less than size Bytes might be written.
+    :param out_file: file to be written
+    :param size: number of Bytes to be written from the current position
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(out_file.fileno(), out_file.tell(), size)
+    except OSError:
+        pass  # e.g. a pipe, or filesystem without fallocate support
+
+
 def get_writer(
     file: typing.BinaryIO,
     packet_size: int = 9000,
@@ -50,6 +212,106 @@ def get_writer(
     return writer
 
 
+def scan_pcap(in_filename: str) -> typing.Tuple[int, int]:
+    """
+    Get the packet size and number of packets in a PCAP(NG) file,
+    in a single pass. Results are cached until the file changes.
+    Note: packet size is taken from the first packet only!
+    :param in_filename: path to file
+    :return: packet size (Bytes), number of packets
+    """
+    stat = os.stat(in_filename)
+    return _scan_pcap(
+        os.path.abspath(in_filename), stat.st_mtime_ns, stat.st_size
+    )
+
+
+# one entry per file scanned, a handful is plenty for repeated transmits
+# (kept small, as entries live for the life of the process)
+@functools.lru_cache(maxsize=8)
+def _scan_pcap(in_filename: str, _mtime_ns: int, size: int):
+    """
+    See scan_pcap.
+    :param _mtime_ns: file modification time, not used here but part of
+    the cache key, so a modified file is scanned again
+    :param size: file size (also part of the cache key)
+    """
+    packet_size = 0
+    n_packets = 0
+    if size == 0:
+        return packet_size, n_packets
+    with open(in_filename, "rb") as in_file, mmap.mmap(
+        in_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buf:
+        uniform = _scan_uniform_pcap(buf)
+        if uniform:
+            return uniform
+        for n_packets, (_, length) in enumerate(frame_spans(buf), 1):
+            if n_packets == 1:
+                # assume all packets are same size
+                packet_size = length
+            elif n_packets % 1000 == 0:
+                # brief sleep to give the control system a chance to do things
+                time.sleep(0.0001)
+    return packet_size, n_packets
+
+
+def _scan_uniform_pcap(buf) -> typing.Union[typing.Tuple[int, int], None]:
+    """
+    Shortcut for classic PCAP files with all packets the same size (e.g.
+    CNIC captures): calculate the number of packets from the file size.
+    :param buf: buffer holding the whole file
+    :return: packet size (Bytes), number of packets;
+    or None if the file doesn't appear to have uniform packet sizes
+    """
+    byte_order = PCAP_BYTE_ORDER.get(bytes(buf[:4]))
+    if byte_order is None or len(buf) < (
+        PCAP_HEADER_SIZE + PCAP_RECORD_HEADER_SIZE
+    ):
+        return None
+    (packet_size,) = struct.unpack_from(
+        byte_order + "I", buf, PCAP_HEADER_SIZE + 8
+    )
+    record_size = PCAP_RECORD_HEADER_SIZE + packet_size
+    n_packets, remainder = divmod(len(buf) - PCAP_HEADER_SIZE, record_size)
+    if remainder:
+        return None
+    # captured length of every record, via a strided view (no copy)
+    captured_lengths = np.ndarray(
+        shape=(n_packets,),
+        dtype=byte_order + "u4",
+        buffer=buf,
+        offset=PCAP_HEADER_SIZE + 8,
+        strides=(record_size,),
+    )
+    if not np.all(captured_lengths == packet_size):
+        return None
+    return packet_size, n_packets
+
+
+def uniform_pcap_records(buf) -> typing.Union[np.ndarray, None]:
+    """
+    View a classic PCAP file with all packets the same size (e.g. CNIC
+    captures) as a 2D array, without copying it.
+    :param buf: buffer holding the whole file (e.g. an mmap)
+    :return: uint8 array with one row per record (record header followed
+    by packet data); or None if the file is not classic PCAP with uniform
+    packet sizes, or has no packets
+    """
+    uniform = _scan_uniform_pcap(buf)
+    if not uniform or not uniform[1]:
+        return None
+    packet_size, n_packets = uniform
+    record_size = PCAP_RECORD_HEADER_SIZE + packet_size
+    records = np.frombuffer(
+        buf,
+        dtype=np.uint8,
+        count=n_packets * record_size,
+        offset=PCAP_HEADER_SIZE,
+    ).reshape(n_packets, record_size)
+    return records
+
+
 def packet_size_from_pcap(in_filename: str) -> int:
     """
     Get the packet size from a given PCAP(NG) file.
@@ -57,22 +319,11 @@ def packet_size_from_pcap(in_filename: str) -> int:
     :param in_filename: path to file
     :return: packet size (Bytes)
     """
-    with open(in_filename, "rb") as in_file:
-        reader = get_reader(in_file)
-        for timestamp, packet in reader:
-            # assess first packet,
-            # assume all packets are same size
-            return len(packet)
+    return scan_pcap(in_filename)[0]
 
 
 def count_packets_in_pcap(in_filename: str) -> int:
     """
     Count the total number of packets from a given PCAP(NG) file.
     """
-    with open(in_filename, "rb") as in_file:
-        reader = get_reader(in_file)
-        for n, (timestamp, packet) in enumerate(reader):
-            if n % 1000 == 0:
-                # brief sleep to give the control system a chance to do things
-                time.sleep(0.0001)
-        return n + 1
+    return scan_pcap(in_filename)[1]
@@ -119,9 +119,10 @@ class Ptp(FpgaPeripheral):
         """
         Get the user-configurable portion of the MAC address (lower 3 bytes)
         """
+        mac_lo = self.profile_mac_lo.value
         a = (self.profile_mac_hi.value & 0xFF000000) >> 24
-        b = self.profile_mac_lo.value & 0xFF
-        c = (self.profile_mac_lo.value & 0xFF00) >> 8
+        b = mac_lo & 0xFF
+        c = (mac_lo & 0xFF00) >> 8
         return IclField(
             description="Low 3 bytes of MAC address",
             value=(a << 16) | (b << 8) | c,
@@ -151,9 +152,9 @@ class Ptp(FpgaPeripheral):
         return IclField(
             value="DC:3C:F6:"  # top 3 bytes are hard coded in PTP core
             + ":".join(
-                f"{self.user_mac_address.value:06x}"[_ : _ + 2]
-                for _ in range(0, 6, 2)
-            ).upper(),
+                f"{byte:02X}"
+                for byte in self.user_mac_address.value.to_bytes(3, "big")
+            ),
             description="Full MAC address",
             type_=str,
         )
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022 CSIRO Space and Astronomy.
+#
+# Distributed under the terms of the CSIRO Open Source Software Licence
+# Agreement. See LICENSE for more info
+"""change_port utility tests"""
+import dpkt
+import pytest
+
+from ska_low_cbf_sw_cnic.change_port import change_port
+from ska_low_cbf_sw_cnic.pcap import get_reader, get_writer
+
+
+def _udp(packet: bytes) -> dpkt.udp.UDP:
+    """Decode the UDP layer of an Ethernet packet"""
+    return dpkt.ethernet.Ethernet(packet).data.data
+
+
+def _with_udp_checksum(packet: bytes) -> bytes:
+    """Have dpkt calculate the UDP checksum of a packet"""
+    eth = dpkt.ethernet.Ethernet(packet)
+    # dpkt fills in zero checksums (UDP only when IP is also zero)
+    eth.data.sum = 0
+    eth.data.data.sum = 0
+    return bytes(eth)
+
+
+def _read_packets(filename) -> list:
+    """Read all packets from a file"""
+    with open(filename, "rb") as in_file:
+        return [packet for _, packet in get_reader(in_file)]
+
+
+@pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+def test_change_port(tmp_path, extension):
+    """All UDP destination ports change & checksums must remain valid"""
+    in_filename = tmp_path / f"in.{extension}"
+    with open(in_filename, "wb") as out_file:
+        writer = get_writer(out_file)
+        with open("tests/codif_sample.pcapng", "rb") as sample:
+            for n, (ts, packet) in enumerate(get_reader(sample)):
+                if n % 2:
+                    # sample has no checksums, add some to every 2nd packet
+                    packet = _with_udp_checksum(packet)
+                writer.writepkt(packet, ts)
+
+    out_filename = tmp_path / f"out.{extension}"
+    with open(in_filename, "rb") as in_file:
+        with open(out_filename, "wb") as out_file:
+            assert change_port(in_file, 1234, out_file) == 20
+
+    original = _read_packets(in_filename)
+    changed = _read_packets(out_filename)
+    assert len(changed) == len(original) == 20
+    for before, after in zip(original, changed):
+        assert _udp(after).dport == 1234
+        assert _udp(after).data == _udp(before).data
+        if _udp(before).sum:
+            # incremental update must match a from-scratch calculation
+            assert _udp(after).sum == _udp(_with_udp_checksum(after)).sum
+        else:
+            assert _udp(after).sum == 0
+
+
+def test_change_port_vlan(tmp_path):
+    """UDP packets behind VLAN tags must be found and modified"""
+    in_filename = tmp_path / "in.pcap"
+    with open(in_filename, "wb") as out_file:
+        writer = get_writer(out_file)
+        with open("tests/codif_sample.pcapng", "rb") as sample:
+            for n, (ts, packet) in enumerate(get_reader(sample)):
+                # 802.1Q tag (VLAN 5) on every 2nd packet
+                if n % 2:
+                    packet = packet[:12] + b"\x81\x00\x00\x05" + packet[12:]
+                writer.writepkt(packet, ts)
+
+    out_filename = tmp_path / "out.pcap"
+    with open(in_filename, "rb") as in_file:
+        with open(out_filename, "wb") as out_file:
+            assert change_port(in_file, 1234, out_file) == 20
+
+    for packet in _read_packets(out_filename):
+        assert _udp(packet).dport == 1234
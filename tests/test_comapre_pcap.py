@@ -5,9 +5,11 @@
 # Distributed under the terms of the CSIRO Open Source Software Licence
 # Agreement. See LICENSE for more info
 """compare_packet utility tests"""
+import pytest
 
-from ska_low_cbf_sw_cnic.compare_pcap import compare_n_packets
-from ska_low_cbf_sw_cnic.pcap import get_reader
+from ska_low_cbf_sw_cnic import compare_pcap
+from ska_low_cbf_sw_cnic.compare_pcap import compare_files, compare_n_packets
+from ska_low_cbf_sw_cnic.pcap import get_reader, get_writer
 
 
 def test_same_file_compares_equal():
@@ -19,3 +21,120 @@ def test_same_file_compares_equal():
         36001,
     )
     assert len(differences) == 0
+
+
+def test_capture_filtered_by_dport():
+    """Captured packets for other ports must be skipped over"""
+    source = list(get_reader(open("tests/codif_sample.pcapng", "rb")))
+    capture = []
+    for ts, packet in source:
+        # same packet, but for dport 36002 (sample uses 36001)
+        other = bytearray(packet)
+        other[36:38] = (36002).to_bytes(2, "big")
+        capture += [(ts, bytes(other)), (ts, packet)]
+
+    differences, n_compared = compare_n_packets(
+        None, iter(source), iter(capture), 36001
+    )
+    assert n_compared == 20
+    assert len(differences) == 0
+
+
+@pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+def test_compare_files(tmp_path, extension):
+    """Vectorised (pcap) & streaming (pcapng) comparisons must agree"""
+    source = list(get_reader(open("tests/codif_sample.pcapng", "rb")))
+    source_filename = tmp_path / f"source.{extension}"
+    capture_filename = tmp_path / f"capture.{extension}"
+    with open(source_filename, "wb") as source_file, open(
+        capture_filename, "wb"
+    ) as capture_file:
+        source_writer = get_writer(source_file)
+        capture_writer = get_writer(capture_file)
+        for n, (ts, packet) in enumerate(source):
+            source_writer.writepkt(packet, ts)
+            other = bytearray(packet)
+            other[36:38] = (36002).to_bytes(2, "big")
+            capture_writer.writepkt(bytes(other), ts)
+            if n in (3, 17):
+                packet = packet[:-1] + b"X"  # corrupt some captured data
+            capture_writer.writepkt(packet, ts)
+
+    with open(source_filename, "rb") as source_file, open(
+        capture_filename, "rb"
+    ) as capture_file:
+        assert compare_files(None, source_file, capture_file, 36001) == (
+            [3, 17],
+            20,
+        )
+    with open(source_filename, "rb") as source_file, open(
+        capture_filename, "rb"
+    ) as capture_file:
+        assert compare_files(10, source_file, capture_file, 36001) == (
+            [3],
+            10,
+        )
+    with open(source_filename, "rb") as source_file, open(
+        capture_filename, "rb"
+    ) as capture_file:
+        with pytest.raises(StopIteration):
+            compare_files(None, source_file, capture_file, 4660)
+
+
+def test_same_pcap_file_compares_equal(tmp_path):
+    """Identical pcap files must have no differences (fast path)"""
+    filename = tmp_path / "source.pcap"
+    with open(filename, "wb") as out_file:
+        writer = get_writer(out_file)
+        for ts, packet in get_reader(open("tests/codif_sample.pcapng", "rb")):
+            writer.writepkt(packet, ts)
+
+    with open(filename, "rb") as source_file, open(
+        filename, "rb"
+    ) as capture_file:
+        assert compare_files(None, source_file, capture_file, 36001) == (
+            [],
+            20,
+        )
+
+
+def test_compare_files_in_batches(tmp_path, monkeypatch):
+    """Differences found in parallel batches must be reported in order"""
+    monkeypatch.setattr(compare_pcap, "COMPARE_BATCH", 4)
+    source = list(get_reader(open("tests/codif_sample.pcapng", "rb")))
+    source_filename = tmp_path / "source.pcap"
+    capture_filename = tmp_path / "capture.pcap"
+    with open(source_filename, "wb") as source_file, open(
+        capture_filename, "wb"
+    ) as capture_file:
+        source_writer = get_writer(source_file)
+        capture_writer = get_writer(capture_file)
+        for n, (ts, packet) in enumerate(source):
+            source_writer.writepkt(packet, ts)
+            if n in (2, 3, 9, 19):
+                packet = packet[:-1] + b"X"  # corrupt some captured data
+            capture_writer.writepkt(packet, ts)
+
+    with open(source_filename, "rb") as source_file, open(
+        capture_filename, "rb"
+    ) as capture_file:
+        assert compare_files(None, source_file, capture_file, 36001) == (
+            [2, 3, 9, 19],
+            20,
+        )
+
+
+@pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+def test_same_file_wrong_dport(tmp_path, extension):
+    """Identical packets for another dport must still be filtered out"""
+    filename = tmp_path / f"source.{extension}"
+    with open(filename, "wb") as out_file:
+        writer = get_writer(out_file)
+        for ts, packet in get_reader(open("tests/codif_sample.pcapng", "rb")):
+            writer.writepkt(packet, ts)
+
+    with open(filename, "rb") as source_file, open(
+        filename, "rb"
+    ) as capture_file:
+        with pytest.raises(StopIteration):
+            compare_files(None, source_file, capture_file, 4660)
@@ -5,14 +5,79 @@
 # Distributed under the terms of the CSIRO Open Source Software Licence
 # Agreement. See LICENSE for more info
 """HBM Packet Controller Tests"""
+import logging
+import mmap
 
+import numpy as np
 import pytest
+from ska_low_cbf_fpga import IclField
 
+from ska_low_cbf_sw_cnic import hbm_packet_controller
 from ska_low_cbf_sw_cnic.hbm_packet_controller import (
     MEM_ALIGN_SIZE,
+    TIMESTAMP_SIZE,
+    HbmPacketController,
     _gap_from_rate,
     _get_padded_size,
 )
+from ska_low_cbf_sw_cnic.pcap import (
+    PCAP_HEADER_SIZE,
+    PCAP_RECORD_HEADER_SIZE,
+    get_writer,
+)
+from ska_low_cbf_sw_cnic.ptp_scheduler import unix_ts_from_ptp
+
+
+class FakeHbm:
+    """Stand-in for the FPGA interface, with HBM buffers held in memory"""
+
+    def __init__(self, sizes):
+        self.buffers = [np.zeros(size, dtype=np.uint8) for size in sizes]
+
+    def read_memory(self, buffer, n_bytes, offset=0):
+        """Read from a buffer, indexed from 1 as per the FPGA"""
+        return self.buffers[buffer - 1][offset : offset + n_bytes].copy()
+
+    def write_memory(self, buffer, data, offset=0):
+        """Write to a buffer, indexed from 1 as per the FPGA"""
+        self.buffers[buffer - 1][offset : offset + data.nbytes] = data
+
+
+def fake_hpc(sizes, **registers) -> HbmPacketController:
+    """
+    Create a HbmPacketController backed by FakeHbm, without an FPGA
+    :param sizes: size of each HBM buffer (Bytes)
+    :param registers: register values, e.g. tx_packet_size=100
+    """
+    hpc = HbmPacketController.__new__(HbmPacketController)
+    # set attributes directly, bypassing FpgaPeripheral's register access
+    vars(hpc).update(
+        _logger=logging.getLogger(__name__),
+        _fields={},
+        _fpga_interface=FakeHbm(sizes),
+        _buffer_offsets=[0] + np.cumsum(sizes).tolist(),
+        _uniform_buffer_size=sizes[0] if len(set(sizes)) == 1 else None,
+        _loaded_pcap=None,
+    )
+    for name, value in registers.items():
+        vars(hpc)[name] = IclField(description=name, type_=int, value=value)
+    return hpc
+
+
+def write_packets(filename, packets):
+    """Write packets to a PCAP(NG) file, file type set by extension"""
+    with open(filename, "wb") as out_file:
+        writer = get_writer(out_file)
+        for n, packet in enumerate(packets):
+            writer.writepkt(packet, n)
+
+
+def random_packets(sizes, seed=0) -> list:
+    """Create packets of random bytes"""
+    rng = np.random.default_rng(seed)
+    return [
+        rng.integers(0, 256, size, dtype=np.uint8).tobytes() for size in sizes
+    ]
 
 
 class TestFunctions:
@@ -59,3 +124,181 @@ class TestFunctions:
         assert _gap_from_rate(
             packet_size, rate, burst_size=burst_size
         ) == pytest.approx(period * 1e9)
+
+
+class TestLoad:
+    """Test loading PCAP(NG) files to HBM"""
+
+    @pytest.mark.parametrize(
+        "extension, sizes, error",
+        [
+            ("pcap", [100] * 10, None),
+            ("pcapng", [100] * 10, None),
+            ("pcap", [100] * 5 + [90] + [100] * 4, ValueError),
+            ("pcapng", [100] * 5 + [90] + [100] * 4, ValueError),
+            ("pcap", [90] * 10, RuntimeError),
+        ],
+    )
+    def test_file_unmapped(
+        self, tmp_path, monkeypatch, extension, sizes, error
+    ):
+        """The file mapping must be closed after loading, even on error"""
+        file_maps = []
+
+        class RecordingMmap(mmap.mmap):
+            """mmap that remembers each instance"""
+
+            def __new__(cls, *args, **kwargs):
+                file_map = super().__new__(cls, *args, **kwargs)
+                file_maps.append(file_map)
+                return file_map
+
+        monkeypatch.setattr(mmap, "mmap", RecordingMmap)
+        filename = tmp_path / f"load.{extension}"
+        write_packets(filename, random_packets(sizes))
+        hpc = fake_hpc([4096, 4096], tx_packet_size=100, tx_packet_to_send=0)
+        with open(filename, "rb") as in_file:
+            if error:
+                with pytest.raises(error):
+                    hpc._load_pcap(in_file)
+            else:
+                hpc._load_pcap(in_file)
+        assert len(file_maps) == 1
+        assert file_maps[0].closed
+
+    @pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+    @pytest.mark.parametrize("sizes", [[2000, 2000], [1000, 1000, 3000]])
+    def test_across_buffers(self, tmp_path, monkeypatch, extension, sizes):
+        """Padded packets must be contiguous, spanning HBM buffers"""
+        # several load batches, each crossing a buffer boundary
+        monkeypatch.setattr(hbm_packet_controller, "LOAD_BATCH_SIZE", 700)
+        packets = random_packets([100] * 30)
+        filename = tmp_path / f"load.{extension}"
+        write_packets(filename, packets)
+        hpc = fake_hpc(sizes, tx_packet_size=100, tx_packet_to_send=30)
+        with open(filename, "rb") as in_file:
+            hpc._load_pcap(in_file)
+
+        padded_size = _get_padded_size(100)
+        expected = np.zeros((len(packets), padded_size), dtype=np.uint8)
+        for row, packet in zip(expected, packets):
+            row[:100] = np.frombuffer(packet, dtype=np.uint8)
+        hbm = np.concatenate(hpc._fpga_interface.buffers)
+        assert hbm[: expected.size].tobytes() == expected.tobytes()
+        assert not hbm[expected.size :].any()
+
+    @pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+    def test_truncated(self, tmp_path, caplog, extension):
+        """Packets that don't fit in HBM must be left out"""
+        packets = random_packets([100] * 30)
+        filename = tmp_path / f"load.{extension}"
+        write_packets(filename, packets)
+        hpc = fake_hpc([1000, 1000], tx_packet_size=100, tx_packet_to_send=0)
+        with caplog.at_level(logging.INFO), open(filename, "rb") as in_file:
+            hpc._load_pcap(in_file)
+
+        # the last packet must end before the end of the last buffer
+        n_fit = (2000 - 1) // _get_padded_size(100)
+        assert f"Loaded {n_fit} packets" in caplog.text
+        hbm = np.concatenate(hpc._fpga_interface.buffers)
+        padded = hbm[: n_fit * _get_padded_size(100)].reshape(n_fit, -1)
+        assert padded[:, :100].tobytes() == b"".join(packets[:n_fit])
+        assert not hbm[padded.size :].any()
+
+
+class TestDump:
+    """Test dumping received packets from HBM to PCAP(NG) files"""
+
+    @staticmethod
+    def fake_rx_hpc(packets, timestamps, sizes, capture_limit):
+        """
+        Create a HbmPacketController with received packets in HBM
+        :param packets: packets to place in HBM, all the same size
+        :param timestamps: 80-bit PTP timestamp of each packet
+        :param sizes: size of each HBM buffer (Bytes)
+        :param capture_limit: rx_packets_to_capture register value
+        """
+        padded_size = _get_padded_size(len(packets[0]))
+        row_size = padded_size + _get_padded_size(TIMESTAMP_SIZE)
+        rows = np.zeros((len(packets), row_size), dtype=np.uint8)
+        for row, packet, timestamp in zip(rows, packets, timestamps):
+            row[: len(packet)] = np.frombuffer(packet, dtype=np.uint8)
+            row[padded_size : padded_size + TIMESTAMP_SIZE] = np.frombuffer(
+                timestamp.to_bytes(TIMESTAMP_SIZE, "big"), dtype=np.uint8
+            )
+        # received data continues from one buffer to the next
+        data = rows.reshape(-1)
+        starts = np.cumsum([0] + sizes[:-1])
+        pieces = [data[start : start + n] for start, n in zip(starts, sizes)]
+        ends = {
+            f"rx_hbm_{buffer}_end_addr": len(piece)
+            for buffer, piece in enumerate(pieces, 1)
+        }
+        hpc = fake_hpc(sizes, rx_packets_to_capture=capture_limit, **ends)
+        for buffer, piece in zip(hpc._fpga_interface.buffers, pieces):
+            buffer[: len(piece)] = piece
+        return hpc
+
+    @pytest.mark.parametrize("extension", ["pcap", "pcapng"])
+    @pytest.mark.parametrize("read_size", [None, 1000])
+    @pytest.mark.parametrize("capture_limit", [30, 25])
+    def test_same_as_dpkt(
+        self, tmp_path, monkeypatch, extension, read_size, capture_limit
+    ):
+        """Output must be identical to writing each packet with dpkt"""
+        if read_size:
+            # packets will be split across read pieces
+            monkeypatch.setattr(
+                hbm_packet_controller, "HBM_READ_SIZE", read_size
+            )
+        packet_size = 100
+        packets = random_packets([packet_size] * 30)
+        rng = np.random.default_rng(1)
+        timestamps = [
+            ((1_700_000_000 + n) << 32) | int(rng.integers(1_000_000_000))
+            for n in range(len(packets))
+        ]
+        hpc = self.fake_rx_hpc(
+            packets, timestamps, [2000, 2000, 4000], capture_limit
+        )
+        filename = tmp_path / f"dump.{extension}"
+        with open(filename, "wb") as out_file:
+            hpc._dump_pcap(out_file, packet_size)
+
+        expected_filename = tmp_path / f"expected.{extension}"
+        with open(expected_filename, "wb") as out_file:
+            writer = get_writer(out_file, packet_size)
+            for packet, timestamp in zip(packets[:capture_limit], timestamps):
+                writer.writepkt(packet, unix_ts_from_ptp(timestamp))
+        assert filename.read_bytes() == expected_filename.read_bytes()
+
+    def test_preallocation_capped(self, tmp_path, monkeypatch):
+        """Space reserved must be limited by the data in HBM"""
+        reserved = []
+        monkeypatch.setattr(
+            hbm_packet_controller,
+            "preallocate",
+            lambda out_file, size: reserved.append(size),
+        )
+        packets = random_packets([100] * 30)
+        hpc = self.fake_rx_hpc(
+            packets, [0] * len(packets), [2000, 2000, 4000], 0xFFFF_FFFF
+        )
+        with open(tmp_path / "dump.pcap", "wb") as out_file:
+            hpc._dump_pcap(out_file, 100)
+        assert reserved == [(30 + 1) * (PCAP_RECORD_HEADER_SIZE + 100)]
+
+    def test_truncated_on_error(self, tmp_path, monkeypatch):
+        """Space reserved must be discarded if the dump fails"""
+        packets = random_packets([100] * 30)
+        hpc = self.fake_rx_hpc(packets, [0] * len(packets), [8000], 30)
+
+        def read_memory(*args):
+            raise RuntimeError("HBM read failed")
+
+        monkeypatch.setattr(hpc._fpga_interface, "read_memory", read_memory)
+        filename = tmp_path / "dump.pcap"
+        with open(filename, "wb") as out_file:
+            with pytest.raises(RuntimeError):
+                hpc._dump_pcap(out_file, 100)
+        assert filename.stat().st_size == PCAP_HEADER_SIZE
@@ -42,6 +42,7 @@ class TestPtp:
         assert (ptp.profile_mac_lo.value & 0xFF00) >> 8 == 0xBA
         assert (ptp.profile_mac_lo.value & 0xFF) == 0xDC
         assert ptp.user_mac_address.value == test_address
+        assert ptp.mac_address.value == "DC:3C:F6:FE:DC:BA"
 
 
 class TestTimestampConversion: